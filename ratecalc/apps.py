@@ -1,7 +1,16 @@
 from __future__ import unicode_literals
 
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class RatecalcConfig(AppConfig):
     name = 'ratecalc'
+
+    def ready(self):
+        from ratecalc.utils.filters import load_filters
+        load_filters()
+
+        if getattr(settings, 'WARM_MODEL_REGISTRY', False):
+            from ratecalc.views import warm_model_registry
+            warm_model_registry()
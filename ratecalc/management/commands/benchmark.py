@@ -0,0 +1,158 @@
+import os
+import copy
+import json
+import time
+import socket
+import platform
+import tempfile
+import numpy as np
+import sncosmo
+
+from django.core.management.base import BaseCommand
+
+from ratecalc.utils.filters import load_filters
+from ratecalc.utils.lightcurve import get_lightcurves
+from ratecalc.utils.rates import (RateCalculator, shell_rate,
+                                  find_peak_phase_mag)
+from ratecalc.utils.transientmodel import load_sed_model
+
+MAG_LIMS = [('shallow', 20.), ('deep', 25.)]
+
+class Command(BaseCommand):
+    help = ('Time the main code paths (rates, light curves, model and filter '
+            'loading) and write the results as JSON')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', default=None,
+                            help='JSON file for the results')
+        parser.add_argument('--compare', default=None,
+                            help='JSON file of a previous run to compare to')
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--sed', default=None,
+                            help='SED file (default: synthetic macronova SED)')
+        parser.add_argument('--only', nargs='+', default=None,
+                            help='run only benchmarks whose names start with '
+                            'one of these prefixes')
+
+    def handle(self, *args, **options):
+        sed_file = options['sed']
+        if sed_file is None:
+            sed_file = os.path.join(tempfile.mkdtemp(), 'sed.dat')
+            write_sed_fixture(sed_file)
+
+        previous = {}
+        if options['compare'] is not None:
+            with open(options['compare']) as f:
+                previous = {b['name']: b for b in json.load(f)['benchmarks']}
+
+        results = []
+        for name, setup, func in get_benchmarks(sed_file):
+            if (options['only'] is not None
+                and not any(name.startswith(p) for p in options['only'])):
+                continue
+
+            result = time_benchmark(name, setup, func, options['repeat'])
+            results.append(result)
+
+            line = '%-32s min %9.2f ms  median %9.2f ms'%(
+                name, 1e3 * result['min'], 1e3 * result['median']
+            )
+            if name in previous:
+                line += '  (x%.2f)'%(result['median']
+                                      / previous[name]['median'])
+            self.stdout.write(line)
+
+        if options['output'] is not None:
+            with open(options['output'], 'w') as f:
+                json.dump({'meta': get_meta(), 'repeat': options['repeat'],
+                           'benchmarks': results}, f, indent=1)
+
+def time_benchmark(name, setup, func, repeat):
+    """Run setup() and then func(*setup()) repeat times; only func is timed
+    """
+    times = []
+    for k in range(repeat):
+        args = setup()
+        t0 = time.time()
+        func(*args)
+        times.append(time.time() - t0)
+
+    return {'name': name, 'times': times, 'min': min(times),
+            'median': float(np.median(times)), 'mean': float(np.mean(times))}
+
+def get_meta():
+    """
+    """
+    return {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'host': socket.gethostname(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'sncosmo': sncosmo.__version__}
+
+def write_sed_fixture(filename):
+    """Deterministic macronova-like SED (cooling blackbody with a light
+    curve that peaks after a few days) in the format of the Rosswog et al.
+    SEDs (columns phase, wavelength, flux)
+    """
+    phase = np.concatenate([[0.001, 0.01, 0.1], np.arange(0.5, 40.01, 0.5)])
+    wave = np.arange(1000., 25001., 20.)
+    temp = 20000. * (1 + phase / 2.)**-0.7
+    lum = phase / (1 + (phase / 3.)**3)
+
+    h, c, k = 6.626e-27, 3e10, 1.38e-16
+    lam = wave * 1e-8
+    bb = (2 * h * c**2 / lam[None, :]**5
+          / (np.exp(h * c / (lam[None, :] * k * temp[:, None])) - 1))
+    flux = lum[:, None] * bb / bb.max(axis=1)[:, None]
+    flux *= 3e-3 / flux.max()
+
+    np.savetxt(filename, np.array([(p, w, f) for p, f_p in zip(phase, flux)
+                                   for w, f in zip(wave, f_p)]), fmt='%g')
+
+def get_benchmarks(sed_file):
+    """List of (name, setup, func)
+    """
+    load_filters()
+    model = load_sed_model(sed_file)
+
+    def no_setup():
+        return ()
+
+    def calc_setup(**kwargs):
+        return lambda: (model, kwargs)
+
+    def get_calc(**kwargs):
+        return lambda: (RateCalculator(model, **kwargs),)
+
+    benchmarks = [
+        ('load_filters', no_setup, load_filters),
+        ('load_sed_model', lambda: (sed_file,), load_sed_model),
+        ('load_sed_model_cached', lambda: (sed_file,),
+         lambda f: load_sed_model(f, use_cache=True)),
+        ('shell_rate', no_setup, lambda: shell_rate(0., 1., nbins=1000)),
+        ('find_peak_phase_mag', lambda: (copy.copy(model),),
+         lambda m: find_peak_phase_mag(m, 'lsstr')),
+        ('get_lightcurves', lambda: (copy.copy(model),),
+         lambda m: get_lightcurves(m, ['lsstg', 'lsstr', 'lssti', 'lsstz',
+                                       'lssty'], ['ab'] * 5)),
+    ]
+
+    for label, mag_lim in MAG_LIMS:
+        kw = {'band': 'lsstr', 'magsys': 'ab', 'mag_lim': mag_lim}
+        for mode, mode_kw in [('peak', {}), ('t_before', {'t_before': 2.}),
+                              ('t_above', {'t_above': 2.})]:
+            kw_ = dict(kw, **mode_kw)
+            benchmarks.append(('RateCalculator_%s_%s'%(mode, label),
+                               calc_setup(**kw_),
+                               lambda m, kw_: RateCalculator(m, **kw_)))
+
+        kw_ = dict(kw, mag_disp=0.5)
+        mag = np.linspace(mag_lim - 5, mag_lim, 41)
+        benchmarks += [
+            ('get_n_expected_%s'%label, get_calc(**kw_),
+             lambda c, mag=mag: c.get_n_expected(mag)),
+            ('get_z_dist_%s'%label, get_calc(**kw_),
+             lambda c, mag_lim=mag_lim: c.get_z_dist(mag_lim)),
+        ]
+
+    return benchmarks
@@ -0,0 +1,224 @@
+import os
+import csv
+import time
+import signal
+import numpy as np
+import multiprocessing
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ratecalc.models import TransientModel
+from ratecalc.views import get_rate_kw, get_transient_model_kw
+from ratecalc.utils.rates import RateCalculator
+from ratecalc.utils.ratemodels import get_rate_model
+from ratecalc.utils.transientmodel import get_transient_model
+from ratecalc.utils.cache import get_table_cache
+
+class Command(BaseCommand):
+    help = ('Compute expected numbers and redshift distributions for all '
+            'transient models (or a selection) on a process pool')
+
+    def add_arguments(self, parser):
+        parser.add_argument('output',
+                            help='CSV file or (for --format npz) directory')
+        parser.add_argument('--format', choices=['csv', 'npz'], default='csv')
+        parser.add_argument('--models', nargs='+', default=None,
+                            help='names of the models (default: all)')
+        parser.add_argument('--band', default='bessellux')
+        parser.add_argument('--magsys', default='ab')
+        parser.add_argument('--mag-start', type=float, default=19.)
+        parser.add_argument('--mag-lim', type=float, default=24.)
+        parser.add_argument('--n-mag', type=int, default=41)
+        parser.add_argument('--area', type=float, default=100.)
+        parser.add_argument('--time', type=float, default=365.25)
+        parser.add_argument('--t-before', type=float, default=None)
+        parser.add_argument('--t-above', type=float, default=None)
+        parser.add_argument('--scale-amplitude', action='store_true',
+                            help='scale models to the peak magnitude of '
+                            'their transient type')
+        parser.add_argument('--processes', type=int, default=None,
+                            help='number of worker processes '
+                            '(default: all CPUs)')
+
+    def handle(self, *args, **options):
+        tms = TransientModel.objects.all()
+        if options['models'] is not None:
+            tms = tms.filter(name__in=options['models'])
+
+        writer = (_CSVWriter(options['output']) if options['format'] == 'csv'
+                  else _NPZWriter(options['output']))
+        done = writer.get_done()
+
+        jobs = [get_job(tm, options) for tm in tms if tm.name not in done]
+        self.stdout.write('%i models, %i done, %i to run'
+                          %(len(jobs) + len(done), len(done), len(jobs)))
+        if len(jobs) == 0:
+            return
+
+        t_start = time.time()
+        pool = multiprocessing.Pool(options['processes'], _init_worker_)
+        try:
+            results = _iter_results_(pool.imap_unordered(run_job, jobs))
+            for k, result in enumerate(results):
+                if 'error' in result:
+                    self.stderr.write('[%i/%i] %s failed: %s'
+                                      %(k + 1, len(jobs), result['name'],
+                                        result['error']))
+                    continue
+
+                writer.write(result)
+                self.stdout.write('[%i/%i] %s (%.1f s, %.1f s elapsed)'
+                                  %(k + 1, len(jobs), result['name'],
+                                    result['time'], time.time() - t_start))
+        except BaseException:
+            # Including KeyboardInterrupt: stop the running jobs instead of
+            # waiting for them
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+            writer.close()
+
+def _init_worker_():
+    """Leave Ctrl-C to the main process, which terminates the pool
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def _iter_results_(results, timeout=1.):
+    """Results of imap_unordered, waited for with a timeout as otherwise
+    Ctrl-C does not interrupt the main process (Python 2)
+    """
+    while True:
+        try:
+            yield results.next(timeout)
+        except multiprocessing.TimeoutError:
+            continue
+        except StopIteration:
+            return
+
+def get_job(tm, options):
+    """Plain-data description of the calculation for a TransientModel (the
+    database is only accessed in the main process)
+    """
+    tt = tm.transient_type
+
+    return {'name': tm.name,
+            'model_kw': get_transient_model_kw(tm),
+            'rate_kw': get_rate_kw(tt, tt.rate),
+            'calc_kw': {'band': options['band'],
+                        'magsys': options['magsys'],
+                        'mag_lim': options['mag_lim'],
+                        'mag_max': (tt.m_B_max if options['scale_amplitude']
+                                    else None),
+                        'mag_disp': (tt.sig_m_B_max if tt.sig_m_B_max > 0
+                                     else None),
+                        'area': options['area'],
+                        'time': options['time'],
+                        't_before': options['t_before'],
+                        't_above': options['t_above']},
+            'mag': np.linspace(options['mag_start'], options['mag_lim'],
+                               options['n_mag'])}
+
+def run_job(job):
+    """Expected numbers on the magnitude grid and redshift distribution at
+    the limiting magnitude for one model
+    """
+    t0 = time.time()
+    try:
+        model = get_transient_model(**job['model_kw'])
+        calc = RateCalculator(model, ratefunc=get_rate_model(**job['rate_kw']),
+                              cache=get_table_cache(), **job['calc_kw'])
+        z, n_z = calc.get_z_dist(job['calc_kw']['mag_lim'])
+
+        return {'name': job['name'], 'time': time.time() - t0,
+                'mag': job['mag'], 'n_expected': calc.get_n_expected(job['mag']),
+                'z': z, 'n_z': n_z}
+    except Exception as e:
+        return {'name': job['name'], 'error': repr(e)}
+
+class _CSVWriter(object):
+    """Long-format CSV (model, quantity, x, value), appended and flushed
+    after each model. The rows of a model are followed by a row
+    (model, 'done', '', ''); rows after the last of these (from an
+    interrupted run) are truncated when the file is opened again.
+    """
+    header = ['model', 'quantity', 'x', 'value']
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._done = set()
+
+        end = 0
+        if os.path.exists(filename):
+            with open(filename, 'rb') as f:
+                line = f.readline()
+                if (line.endswith('\n')
+                    and next(csv.reader([line]), []) == self.header):
+                    end = f.tell()
+                elif line != '':
+                    raise CommandError('%s is not an output file of run_batch'
+                                       %filename)
+
+                for line in iter(f.readline, ''):
+                    if not line.endswith('\n'):
+                        break
+                    row = next(csv.reader([line]), [])
+                    if len(row) > 1 and row[1] == 'done':
+                        self._done.add(row[0])
+                        end = f.tell()
+
+        self._file = open(filename, 'ab')
+        self._file.truncate(end)
+        self._writer = csv.writer(self._file)
+        if end == 0:
+            self._writer.writerow(self.header)
+            self._file.flush()
+
+    def get_done(self):
+        return set(self._done)
+
+    def write(self, result):
+        for x, y in zip(result['mag'], result['n_expected']):
+            self._writer.writerow([result['name'], 'n_expected', x, y])
+        for x, y in zip(result['z'], result['n_z']):
+            self._writer.writerow([result['name'], 'z_dist', x, y])
+        self._writer.writerow([result['name'], 'done', '', ''])
+        self._file.flush()
+        self._done.add(result['name'])
+
+    def close(self):
+        self._file.close()
+
+class _NPZWriter(object):
+    """One .npz file per model in a directory (written atomically)
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _get_path_(self, name):
+        return os.path.join(self.directory,
+                            '%s.npz'%name.replace(os.sep, '_'))
+
+    def get_done(self):
+        done = set()
+        for filename in os.listdir(self.directory):
+            if filename.endswith('.npz'):
+                with np.load(os.path.join(self.directory, filename)) as data:
+                    done.add(str(data['name']))
+
+        return done
+
+    def write(self, result):
+        path = self._get_path_(result['name'])
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, name=result['name'], mag=result['mag'],
+                     n_expected=result['n_expected'], z=result['z'],
+                     n_z=result['n_z'])
+        os.rename(path + '.tmp', path)
+
+    def close(self):
+        pass
@@ -0,0 +1,35 @@
+import json
+import logging
+
+from utils.timing import StageTimer, record_stats
+
+logger = logging.getLogger('ratecalc.timing')
+
+class TimingMiddleware(object):
+    """Attach a StageTimer to each request (see utils/timing.py) and report
+    the stages timed by the view in the Server-Timing header, the log and
+    the statistics shown by the stats view
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.timer = StageTimer()
+        response = self.get_response(request)
+        request.timer.finish()
+
+        if len(request.timer.stages) > 0:
+            view = (request.resolver_match.url_name
+                    if request.resolver_match is not None
+                    else request.path_info)
+            response['Server-Timing'] = request.timer.get_header()
+            record_stats(view, request.timer)
+            logger.info(json.dumps({
+                'view': view, 'path': request.path_info,
+                'method': request.method, 'status': response.status_code,
+                'total_ms': round(1e3 * request.timer.total, 1),
+                'stages_ms': {name: round(1e3 * dt, 1)
+                              for name, dt in request.timer.stages.items()}
+            }))
+
+        return response
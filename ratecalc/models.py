@@ -23,6 +23,11 @@ class TransientType(models.Model):
     m_B_max = models.FloatField(default=0)
     sig_m_B_max = models.FloatField(default=0)
     rate = models.FloatField(default=3e-5)
+    # See utils/ratemodels.py; rate is the rate at z = 0 and rate_params
+    # holds further parameters as JSON (e.g. '{"alpha": 1.5}')
+    rate_model = models.CharField(max_length=32, default='constant')
+    rate_params = models.CharField(max_length=256, blank=True, default='')
+    rate_file = models.CharField(max_length=256, blank=True, default='')
 
     def __unicode__(self): 
         return self.name
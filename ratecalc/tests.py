@@ -1,3 +1,866 @@
-from django.test import TestCase
+import os
+import copy
+import json
+import shutil
+import tempfile
+import threading
+import numpy as np
+import sncosmo
+from StringIO import StringIO
+from scipy.integrate import quad
 
-# Create your tests here.
+from django.core.cache import caches
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import SimpleTestCase, TestCase
+
+from ratecalc.models import Category, TransientType, TransientModel
+from ratecalc.management.commands.run_batch import _CSVWriter, _NPZWriter
+from ratecalc.views import get_initial_data
+from ratecalc.utils.formatdata import read_binary
+from ratecalc.utils.cache import TableCache, _write_atomic_
+from ratecalc.utils.responsecache import canonical, get_response_key
+from ratecalc.utils.simulate import SurveySimulator
+from ratecalc.utils.sweep import sweep_n_expected, SWEEP_DIMS
+from ratecalc.utils.ratemodels import (ConstantRate, PowerLawRate,
+                                       MadauDickinsonRate, TabulatedRate,
+                                       get_rate_model, _max_rate_models)
+
+from ratecalc.utils.rates import (RateCalculator, bandflux, bandflux_grid,
+                                  lightcurve_grid,
+                                  t_above_lim_grid, mag_t_above_grid,
+                                  get_mag_z_grid, find_peak_grid, shell_rate,
+                                  get_table_key, _cosmo)
+from ratecalc.utils.cosmology import get_cosmology_table
+
+def get_analytic_model(p_peak=0., p_min=-20., p_max=50., width=8.):
+    """Model with a flat spectrum and a Gaussian light curve (in flux)
+    peaking at rest-frame phase p_peak
+    """
+    phase = np.linspace(p_min, p_max, int(p_max - p_min) + 1)
+    wave = np.linspace(1000., 12000., 111)
+    flux = np.exp(-0.5 * ((phase - p_peak) / width)**2)[:, None]
+    flux = 1e-8 * np.tile(flux, (1, len(wave)))
+
+    return sncosmo.Model(source=sncosmo.TimeSeriesSource(phase, wave, flux))
+
+def write_sed_file(filename):
+    """SED of get_analytic_model (without the phases before the peak and
+    scaled to a peak of about -18 mag at 10 pc) in the ascii format of
+    load_sed_model
+    """
+    source = get_analytic_model()._source
+    phase = np.arange(1., 51.)
+    wave = np.linspace(1000., 12000., 111)
+    flux = 1e7 * source._flux(phase, wave)
+    np.savetxt(filename, np.column_stack((np.repeat(phase, len(wave)),
+                                          np.tile(wave, len(phase)),
+                                          flux.ravel())))
+
+class ViewTestCase(TestCase):
+    """Database with a single model (mn2) loaded from an analytic SED file
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.mkdtemp()
+        cls.sed_file = os.path.join(cls.tmp_dir, 'sed.dat')
+        write_sed_file(cls.sed_file)
+        super(ViewTestCase, cls).setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super(ViewTestCase, cls).tearDownClass()
+        shutil.rmtree(cls.tmp_dir)
+
+    @classmethod
+    def setUpTestData(cls):
+        TransientModel.objects.create(
+            name='mn2', model_file=cls.sed_file, host_extinction=False,
+            category=Category.objects.create(name='file',
+                                             model_type='load-file'),
+            transient_type=TransientType.objects.create(
+                name='SN', m_B_max=-19., sig_m_B_max=0.5, rate=3e-5,
+                rate_model='power-law', rate_params='{"alpha": 1.5}'
+            )
+        )
+
+    def setUp(self):
+        caches['responses'].clear()
+
+    def get_post_data(self, url):
+        """Initial values of the form of the HTML view at url as POST data
+        (as submitted by a browser, i.e. without unchecked boxes)
+        """
+        data = get_initial_data(self.client.get(url).context['form'])
+        return {k: v for k, v in data.items()
+                if v is not None and v is not False}
+
+class FormValidationTests(ViewTestCase):
+    """Invalid or incomplete POSTs to the JSON and export views
+    """
+    def test_incomplete_post(self):
+        data = self.get_post_data('/ratecalc/expected/mn2/')
+        response = self.client.post('/ratecalc/expected/mn2/json/', data)
+        self.assertEqual(response.status_code, 200)
+
+        del data['band_max']
+        response = self.client.post('/ratecalc/expected/mn2/json/', data)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('band_max', json.loads(response.content)['errors'])
+
+    def test_invalid_post(self):
+        data = self.get_post_data('/ratecalc/lightcurve/mn2/')
+        data['area'] = 'none'
+        response = self.client.post('/ratecalc/lightcurve/mn2/json/', data)
+        self.assertEqual(response.status_code, 200)
+
+        data = self.get_post_data('/ratecalc/redshift/mn2/')
+        data['area'] = 'none'
+        response = self.client.post('/ratecalc/redshift/mn2/json/', data)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('area', json.loads(response.content)['errors'])
+
+        response = self.client.post('/ratecalc/redshift/mn2/', data)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Invalid input (area:', response.context['plot'])
+
+class ExportTests(ViewTestCase):
+    """The CSV, .npy and binary exports compared to the JSON data
+    """
+    def get_table(self, url, fmt, data=None):
+        if data is None:
+            response = self.client.get('%sexport/%s/'%(url, fmt))
+        else:
+            response = self.client.post('%sexport/%s/'%(url, fmt), data)
+        self.assertEqual(response.status_code, 200)
+        content = ''.join(response.streaming_content)
+
+        if fmt == 'csv':
+            lines = content.splitlines()
+            return (lines[0].split(','),
+                    np.loadtxt(lines[1:], delimiter=',', ndmin=2))
+        elif fmt == 'npy':
+            return None, np.load(StringIO(content))
+
+        filename = os.path.join(self.tmp_dir, 'export.bin')
+        with open(filename, 'wb') as f:
+            f.write(content)
+        return read_binary(filename)
+
+    def check_round_trip(self, url, data=None):
+        if data is None:
+            json_data = json.loads(self.client.get(url + 'json/').content)
+        else:
+            json_data = json.loads(self.client.post(url + 'json/',
+                                                    data).content)
+        expected = np.column_stack(
+            [json_data['x']['values']]
+            + [s['values'] for s in json_data['series']]
+        ).astype(float)
+        columns = ([json_data['x']['name']]
+                   + [s['label'] for s in json_data['series']])
+
+        for fmt in ['csv', 'npy', 'bin']:
+            columns_, table = self.get_table(url, fmt, data)
+            if columns_ is not None:
+                self.assertEqual(list(columns_), columns)
+            np.testing.assert_allclose(
+                table, expected, rtol=(1e-6 if fmt == 'bin' else 1e-12)
+            )
+
+    def test_round_trip(self):
+        for kind in ['lightcurve', 'expected', 'redshift']:
+            self.check_round_trip('/ratecalc/%s/mn2/'%kind)
+
+    def test_round_trip_post(self):
+        url = '/ratecalc/expected/mn2/'
+        data = self.get_post_data(url)
+        data.update(band1='bessellb', mag_lim=23.)
+        self.check_round_trip(url, data)
+
+    def test_incomplete_post(self):
+        data = self.get_post_data('/ratecalc/expected/mn2/')
+        del data['band_max']
+        for fmt in ['csv', 'npy', 'bin']:
+            response = self.client.post(
+                '/ratecalc/expected/mn2/export/%s/'%fmt, data
+            )
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('band_max', json.loads(response.content)['errors'])
+
+class BandfluxTests(SimpleTestCase):
+    """bandflux and bandflux_grid against sncosmo for effects in each frame
+    """
+    def get_model(self):
+        model = get_analytic_model()
+        model.add_effect(sncosmo.CCM89Dust(), 'host', 'rest')
+        model.add_effect(sncosmo.CCM89Dust(), 'lens', 'free')
+        model.add_effect(sncosmo.CCM89Dust(), 'mw', 'obs')
+        model.set(hostebv=0.2, lensebv=0.1, lensz=0.3, mwebv=0.05)
+        return model
+
+    def test_frames(self):
+        model = self.get_model()
+        z = np.array([0.1, 0.5])
+        phase = np.array([-5., 0., 10.])
+        f_grid = bandflux_grid(model, 'bessellb', z, phase)
+        for k, z_ in enumerate(z):
+            model.set(z=z_, t0=0.)
+            f = model.bandflux('bessellb', phase * (1 + z_), zp=30.,
+                               zpsys='ab')
+            np.testing.assert_allclose(f_grid[k], f, rtol=1e-6)
+            np.testing.assert_allclose(
+                bandflux(model, 'bessellb', phase * (1 + z_)), f, rtol=1e-6
+            )
+
+    def test_unsupported_frame(self):
+        model = self.get_model()
+        model._effect_frames[1] = 'other'
+        self.assertRaises(ValueError, bandflux, model, 'bessellb', 0.)
+        self.assertRaises(ValueError, bandflux_grid, model, 'bessellb',
+                          np.array([0.1]), np.array([0.]))
+
+class TAboveGridTests(SimpleTestCase):
+    """t_above_lim_grid and mag_t_above_grid compared to brute force scans
+    of model.bandmag at each redshift
+    """
+    band = 'bessellb'
+    z = np.array([0.01, 0.1, 0.3])
+    dt = 0.005
+
+    def setUp(self):
+        self.model = get_analytic_model()
+        self.phase, self.mags = lightcurve_grid(self.model, self.band, self.z)
+
+    def scan(self, z):
+        """Observer-frame times and magnitudes sampled with spacing dt
+        """
+        model = copy.copy(self.model)
+        model.set(z=z)
+        t = np.arange(model.mintime(), model.maxtime(), self.dt)
+        return t, model.bandmag(self.band, 'ab', t)
+
+    def test_t_above_lim(self):
+        for k, z in enumerate(self.z):
+            t, m = self.scan(z)
+            limits = m.min() + np.array([0.1, 0.5, 1., 2.])
+            t_above = t_above_lim_grid(self.phase[k], self.mags[k:k+1],
+                                       limits)[0]
+            t_brute = np.array([np.sum(m < l) * self.dt for l in limits])
+            np.testing.assert_allclose(t_above, t_brute, atol=0.05)
+
+    def test_mag_t_above(self):
+        for k, z in enumerate(self.z):
+            t, m = self.scan(z)
+            t_above = np.array([1., 5., 10., 20.])
+            m_lim = mag_t_above_grid(self.phase[k], self.mags[k:k+1],
+                                     t_above)[0]
+            m_brute = np.sort(m)[(t_above / self.dt).astype(int)]
+            np.testing.assert_allclose(m_lim, m_brute, atol=2e-3)
+
+    def test_never_above(self):
+        limits = np.nanmin(self.mags, axis=1)[:, None] - [0.01, 1.]
+        t_above = t_above_lim_grid(self.phase, self.mags, limits)
+        np.testing.assert_array_equal(t_above, 0.)
+
+        duration = self.phase[:, -1] - self.phase[:, 0]
+        m_lim = mag_t_above_grid(self.phase, self.mags,
+                                 (duration + 1.)[:, None])
+        self.assertTrue(np.all(np.isnan(m_lim)))
+
+    def test_always_above(self):
+        duration = self.phase[:, -1] - self.phase[:, 0]
+        for k, z in enumerate(self.z):
+            t, m = self.scan(z)
+            t_above = t_above_lim_grid(self.phase[k], self.mags[k:k+1],
+                                       [m.max() + 0.1, 99.])[0]
+            np.testing.assert_allclose(t_above, duration[k])
+            np.testing.assert_allclose(duration[k], t[-1] - t[0],
+                                       atol=self.dt)
+
+        m_lim = mag_t_above_grid(self.phase, self.mags, duration[:, None])
+        np.testing.assert_allclose(m_lim[:, 0], np.nanmax(self.mags, axis=1))
+
+        m_lim = mag_t_above_grid(self.phase, self.mags, [0.])
+        np.testing.assert_allclose(m_lim[:, 0], np.nanmin(self.mags, axis=1))
+
+    def test_t_before_edge(self):
+        # Up to the start of the light curve (20 rest-frame days before the
+        # peak) and exactly at it
+        distmod = get_cosmology_table(_cosmo).distmod(self.z)
+        for t_before in [5., 19.5]:
+            t_obs = t_before * (1 + self.z)
+            m = get_mag_z_grid(self.model, self.band, self.z,
+                               t_before=t_obs) - distmod
+            for k, z in enumerate(self.z):
+                model = copy.copy(self.model)
+                model.set(z=z)
+                m_brute = model.bandmag(self.band, 'ab', -t_obs[k])
+                self.assertAlmostEqual(m[k], m_brute, places=3)
+
+        m = get_mag_z_grid(self.model, self.band, self.z,
+                           t_before=20. * (1 + self.z)) - distmod
+        for k, z in enumerate(self.z):
+            model = copy.copy(self.model)
+            model.set(z=z)
+            self.assertAlmostEqual(m[k], model.bandmag(self.band, 'ab',
+                                                       model.mintime()),
+                                   places=3)
+
+class FindPeakGridTests(SimpleTestCase):
+    """find_peak_grid (and _refine_peak_) compared to dense sampling of
+    model.bandmag at each redshift
+    """
+    bands = ['bessellb', 'bessellv']
+    z = np.array([0.01, 0.1, 0.3])
+    dt = 0.01
+
+    def scan(self, model, band, z):
+        """Observer-frame time and magnitude of the brightest dense sample
+        """
+        model = copy.copy(model)
+        model.set(z=z)
+        t = np.linspace(model.mintime(), model.maxtime(),
+                        int((model.maxtime() - model.mintime()) / self.dt) + 1)
+        m = model.bandmag(band, 'ab', t)
+        return t[np.argmin(m)], m.min()
+
+    def check_peak(self, model):
+        p_peak, m_peak = find_peak_grid(model, self.bands, self.z)
+        for i, band in enumerate(self.bands):
+            for k, z in enumerate(self.z):
+                t, m = self.scan(model, band, z)
+                self.assertLess(abs(m_peak[i, k] - m), 1e-3)
+                self.assertLessEqual(m_peak[i, k], m + 1e-6)
+                self.assertLess(abs(p_peak[i, k] - t), 0.1 * (1 + z))
+
+    def test_peak(self):
+        # Peak between the native phases of the source
+        self.check_peak(get_analytic_model(p_peak=3.5))
+
+    def test_peak_at_start(self):
+        self.check_peak(get_analytic_model(p_peak=-20.))
+
+    def test_peak_at_end(self):
+        self.check_peak(get_analytic_model(p_peak=50.))
+
+    def test_single_band_amplitude(self):
+        model = get_analytic_model(p_peak=3.5)
+        p_peak, m_peak = find_peak_grid(model, self.bands[0], self.z)
+        p_amp, m_amp = find_peak_grid(model, self.bands[0], self.z,
+                                      amplitude=[1., 10., 0.1])
+        np.testing.assert_allclose(p_amp, p_peak)
+        np.testing.assert_allclose(m_amp - m_peak, [0., -2.5, 2.5])
+
+class SurveySimulatorTests(SimpleTestCase):
+    """Seeded simulations compared to the analytic expected numbers
+    """
+    mag_lim = 20.
+
+    def get_calc(self, mag_disp=None):
+        model = get_analytic_model()
+        model.set(amplitude=1e7)
+        return RateCalculator(model, band='bessellb', mag_lim=self.mag_lim,
+                              mag_disp=mag_disp, area=30., time=365.25,
+                              ratefunc=(lambda z: 3e-5))
+
+    def test_mean_counts(self):
+        for mag_disp in [None, 0.3]:
+            calc = self.get_calc(mag_disp)
+            n = calc.get_n_expected(self.mag_lim)
+            counts = SurveySimulator(calc, self.mag_lim).simulate_counts(
+                100, seed=1
+            )
+            self.assertLess(abs(counts.mean() - n),
+                            4 * counts.std() / np.sqrt(len(counts)))
+
+    def test_independent_of_calc_state(self):
+        calc = self.get_calc(0.3)
+        counts = SurveySimulator(calc, self.mag_lim).simulate_counts(
+            20, seed=1
+        )
+        # Extends the m(z) table and raises calc.mag_lim
+        calc.get_n_expected(self.mag_lim + 2.)
+        sim = SurveySimulator(calc, self.mag_lim)
+        self.assertEqual(sim.mag_lim, self.mag_lim)
+        # Only the spline through the longer table differs
+        self.assertAlmostEqual(sim.simulate_counts(20, seed=1).mean(),
+                               counts.mean(), delta=1e-3 * counts.mean())
+
+    def test_processes(self):
+        sim = SurveySimulator(self.get_calc(0.3), self.mag_lim, host_ebv=0.1)
+        catalog, summary = sim.simulate(seed=3, chunk_size=500, processes=1)
+        catalog_, summary_ = sim.simulate(seed=3, chunk_size=500,
+                                          processes=2)
+        self.assertGreater(summary['n_total'], 1000)
+        self.assertEqual(summary, summary_)
+        np.testing.assert_array_equal(catalog, catalog_)
+
+class SweepTests(SimpleTestCase):
+    """sweep_n_expected compared to RateCalculator and the axis bookkeeping
+    of SweepResult
+    """
+    mags = np.array([20., 21., 22.])
+    bands = ['bessellb', 'bessellv']
+
+    @classmethod
+    def setUpClass(cls):
+        super(SweepTests, cls).setUpClass()
+        cls.model = get_analytic_model()
+        cls.model.set(amplitude=1e7)
+        cls.result = sweep_n_expected(cls.model, cls.mags,
+                                      mag_disp=[None, 0.3], area=[30., 100.],
+                                      time=365.25, rate=[1., 2.],
+                                      band=cls.bands)
+
+    def test_n_expected(self):
+        for band in self.bands:
+            for mag_disp in [None, 0.3]:
+                calc = RateCalculator(self.model, band=band,
+                                      mag_lim=self.mags.max(),
+                                      mag_disp=mag_disp, area=30.,
+                                      ratefunc=ConstantRate(1.))
+                n = self.result.sel(band=band, mag_disp=mag_disp or 0.,
+                                    area=30., time=365.25, rate=1.)
+                self.assertEqual(n.dims, ('mag_lim',))
+                np.testing.assert_allclose(n.values,
+                                           calc.get_n_expected(self.mags),
+                                           rtol=1e-3)
+
+    def test_axes(self):
+        result = self.result
+        self.assertEqual(result.dims, SWEEP_DIMS)
+        self.assertEqual(result.values.shape, (3, 2, 2, 1, 2, 2))
+
+        sel = result.sel(area=100., band='bessellv')
+        self.assertEqual(sel.dims, ('mag_lim', 'mag_disp', 'time', 'rate'))
+        np.testing.assert_array_equal(sel.values,
+                                      result.values[:, :, 1, :, :, 1])
+
+        # Nearest value for floats
+        np.testing.assert_array_equal(result.sel(mag_lim=20.9).values,
+                                      result.values[1])
+        np.testing.assert_allclose(result.sel(rate=2.).values,
+                                   2 * result.sel(rate=1.).values)
+        np.testing.assert_allclose(result.sel(area=100.).values,
+                                   result.sel(area=30.).values / 0.3)
+
+        squeezed = sel.squeeze()
+        self.assertEqual(squeezed.dims, ('mag_lim', 'mag_disp', 'rate'))
+        np.testing.assert_array_equal(squeezed.values,
+                                      sel.values[:, :, 0, :])
+        np.testing.assert_array_equal(
+            squeezed.sel(mag_lim=22., mag_disp=0.3, rate=2.).values,
+            result.values[2, 1, 1, 0, 1, 1]
+        )
+
+class RateModelTests(SimpleTestCase):
+    """Rate models: shapes, normalisation, cumulative numbers and the LRU
+    of get_rate_model
+    """
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.rate_file = os.path.join(self.tmp_dir, 'rate.dat')
+        np.savetxt(self.rate_file, [[0., 2e-5], [1., 6e-5], [2., 4e-5]])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def get_models(self):
+        return [ConstantRate(2e-5), PowerLawRate(2e-5, alpha=2.),
+                MadauDickinsonRate(2e-5),
+                TabulatedRate.from_file(self.rate_file)]
+
+    def test_shape(self):
+        for model in self.get_models():
+            self.assertAlmostEqual(model(0.), 2e-5)
+            self.assertEqual(np.shape(model(0.5)), ())
+            self.assertEqual(model(np.zeros((3, 4))).shape, (3, 4))
+            np.testing.assert_allclose(model(np.zeros(5)), 2e-5)
+
+        z = np.array([0.5, 1., 3.])
+        np.testing.assert_allclose(PowerLawRate(2e-5, alpha=2.)(z),
+                                   2e-5 * (1 + z)**2)
+        np.testing.assert_allclose(TabulatedRate.from_file(self.rate_file)(z),
+                                   [4e-5, 6e-5, 4e-5])
+        np.testing.assert_allclose(
+            TabulatedRate.from_file(self.rate_file, r0=1e-5)(z),
+            [2e-5, 3e-5, 2e-5]
+        )
+        # Star-formation history peaks around z = 1.9
+        z = np.linspace(0., 5., 501)
+        self.assertAlmostEqual(z[np.argmax(MadauDickinsonRate(2e-5)(z))],
+                               1.86, delta=0.05)
+
+    def test_n_cum(self):
+        table = get_cosmology_table(_cosmo)
+        def dn_dz(z, model):
+            dz = 1e-4 * (1 + z)
+            dv_dz = (table.comoving_volume(z + dz)
+                     - table.comoving_volume(max(z - dz, 0.))) / (2 * dz)
+            return model(z) / (1 + z) * dv_dz
+
+        for model in self.get_models():
+            z = np.array([0.01, 0.1, 0.5, 1.5])
+            n_quad = np.array([quad(dn_dz, 0., z_, args=(model,),
+                                    epsabs=0., epsrel=1e-6, limit=200)[0]
+                               for z_ in z])
+            np.testing.assert_allclose(model.get_n_cum(z, _cosmo), n_quad,
+                                       rtol=1e-3)
+
+            z_binedges = np.linspace(0., 1.5, 31)
+            sh_rate, z_ctr = shell_rate(0., 1.5, model, z_binedges=z_binedges,
+                                        time=365.25 / 2, area=0.5)
+            sh_rate_quad = [quad(dn_dz, z0, z1, args=(model,))[0] / 4.
+                            for z0, z1 in zip(z_binedges[:-1],
+                                              z_binedges[1:])]
+            np.testing.assert_allclose(sh_rate, sh_rate_quad, rtol=1e-3)
+            np.testing.assert_allclose(z_ctr, 0.5 * (z_binedges[1:]
+                                                     + z_binedges[:-1]))
+
+    def test_get_rate_model(self):
+        with self.assertRaises(ValueError):
+            get_rate_model('unknown')
+
+        model = get_rate_model('power-law', 2e-5, alpha=2.)
+        self.assertIsInstance(model, PowerLawRate)
+        self.assertEqual(model.alpha, 2.)
+        self.assertIs(get_rate_model('power-law', 2e-5, alpha=2.), model)
+        self.assertIsNot(get_rate_model('power-law', 3e-5, alpha=2.), model)
+        self.assertIsNot(get_rate_model('power-law', 2e-5, alpha=1.), model)
+
+        model = get_rate_model('tabulated', None, rate_file=self.rate_file)
+        self.assertIs(get_rate_model('tabulated', None,
+                                     rate_file=self.rate_file), model)
+        np.savetxt(self.rate_file, [[0., 2e-5], [1., 8e-5], [2., 4e-5],
+                                    [3., 1e-5]])
+        model_ = get_rate_model('tabulated', None, rate_file=self.rate_file)
+        self.assertIsNot(model_, model)
+        self.assertAlmostEqual(model_(1.), 8e-5)
+
+    def test_lru(self):
+        model = get_rate_model('constant', 1e-5)
+        for k in range(_max_rate_models - 1):
+            get_rate_model('constant', 1e-5 * (k + 2))
+        self.assertIs(get_rate_model('constant', 1e-5), model)
+
+        for k in range(_max_rate_models):
+            get_rate_model('constant', 1e-3 * (k + 2))
+        self.assertIsNot(get_rate_model('constant', 1e-5), model)
+
+class TableCacheTests(SimpleTestCase):
+    """On-disk cache of the magnitude-redshift tables
+    """
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.directory = os.path.join(self.tmp_dir, 'mz_tables')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def get_files(self):
+        return sorted(os.listdir(self.directory))
+
+    def register_band(self, shift=0.):
+        wave = np.linspace(4000., 5000., 101)
+        trans = np.exp(-0.5 * ((wave - 4500. - shift) / 200.)**2)
+        sncosmo.register(sncosmo.Bandpass(wave, trans, name='ratecalc-test'),
+                         force=True)
+
+    def register_magsys(self, flux=1e-9):
+        wave = np.linspace(1000., 20000., 191)
+        sncosmo.register(sncosmo.SpectralMagSystem(
+            sncosmo.Spectrum(wave, flux * np.ones(len(wave)))
+        ), 'ratecalc-test', force=True)
+
+    def test_get_set(self):
+        cache = TableCache(self.directory)
+        key = cache.get_key('a', 1.)
+        self.assertIsNone(cache.get(key))
+        cache.set(key, z=np.arange(3.), m=np.ones(3))
+        data = cache.get(key)
+        self.assertEqual(sorted(data.keys()), ['m', 'z'])
+        np.testing.assert_array_equal(data['z'], np.arange(3.))
+
+        self.assertNotEqual(cache.get_key('a', 1.), cache.get_key('a', 2.))
+
+    def test_version(self):
+        cache = TableCache(self.directory)
+        key = cache.get_key('a')
+        cache.set(key, z=np.arange(3.))
+
+        cache_ = TableCache(self.directory, version=cache.version + 1)
+        self.assertNotEqual(cache_.get_key('a'), key)
+        # Entries of other versions are ignored even under the same key
+        self.assertIsNone(cache_.get(key))
+        self.assertIsNotNone(cache.get(key))
+
+    def test_eviction(self):
+        cache = TableCache(self.directory, max_size=None)
+        keys = [cache.get_key(k) for k in range(4)]
+        for k, key in enumerate(keys):
+            cache.set(key, z=np.zeros(1000))
+            os.utime(cache._get_path_(key), (1e9 + k, 1e9 + k))
+        size = os.path.getsize(cache._get_path_(keys[0]))
+
+        # Reading marks an entry as recently used
+        cache.get(keys[0])
+        cache.max_size = 3 * size
+        cache._evict_()
+        self.assertIsNone(cache.get(keys[1]))
+        for key in [keys[0], keys[2], keys[3]]:
+            self.assertIsNotNone(cache.get(key))
+
+    def test_concurrent_set(self):
+        # Writers of the same key used to share the temporary file
+        cache = TableCache(self.directory)
+        key = cache.get_key('a')
+        errors = []
+
+        def _set():
+            try:
+                for k in range(10):
+                    cache.set(key, z=np.arange(1e5))
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=_set) for k in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(self.get_files(), ['%s.npz'%key])
+        np.testing.assert_array_equal(cache.get(key)['z'], np.arange(1e5))
+
+    def test_failed_write(self):
+        cache = TableCache(self.directory)
+        key = cache.get_key('a')
+
+        def _fail(f):
+            raise IOError('disk full')
+        os.makedirs(self.directory)
+        with self.assertRaises(IOError):
+            _write_atomic_(cache._get_path_(key), _fail)
+        self.assertEqual(self.get_files(), [])
+
+        # Write failures are ignored by set
+        with open(os.path.join(self.tmp_dir, 'file'), 'w'):
+            pass
+        cache = TableCache(os.path.join(self.tmp_dir, 'file', 'mz_tables'))
+        cache.set(key, z=np.arange(3.))
+        self.assertIsNone(cache.get(key))
+
+    def test_bandpass_key(self):
+        # Tables used to be keyed by the name of the bandpass only
+        cache = TableCache(self.directory)
+        model = get_analytic_model()
+        model.set(amplitude=1e7)
+        args = (None, None, None, -3.5, 0.05, _cosmo)
+
+        self.register_band()
+        key = get_table_key(cache, model, 'ratecalc-test', 'ab', *args)
+        self.assertEqual(
+            get_table_key(cache, model, 'ratecalc-test', 'ab', *args), key
+        )
+        self.register_magsys()
+        key_ms = get_table_key(cache, model, 'ratecalc-test', 'ratecalc-test',
+                               *args)
+        self.assertNotEqual(key_ms, key)
+        self.register_magsys(flux=2e-9)
+        self.assertNotEqual(get_table_key(cache, model, 'ratecalc-test',
+                                          'ratecalc-test', *args), key_ms)
+        self.assertNotEqual(
+            get_table_key(cache, model, 'ratecalc-test', 'ab',
+                          (-19., 'ratecalc-test', 'ab'), *args[1:]), key
+        )
+
+        calc = RateCalculator(model, band='ratecalc-test', cache=cache)
+        calc_ = RateCalculator(model, band='ratecalc-test', cache=cache)
+        np.testing.assert_array_equal(calc_._m_grid, calc._m_grid)
+        self.assertEqual(len(self.get_files()), 1)
+
+        self.register_band(shift=300.)
+        self.assertNotEqual(
+            get_table_key(cache, model, 'ratecalc-test', 'ab', *args), key
+        )
+        calc_ = RateCalculator(model, band='ratecalc-test', cache=cache)
+        self.assertEqual(len(self.get_files()), 2)
+        m = RateCalculator(model, band='ratecalc-test')._m_grid
+        np.testing.assert_allclose(calc_._m_grid, m)
+        self.assertFalse(np.allclose(calc_._m_grid, calc._m_grid))
+
+class BatchWriterTests(ViewTestCase):
+    """Resuming the output of run_batch
+    """
+    def setUp(self):
+        super(BatchWriterTests, self).setUp()
+        self.out_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.out_dir)
+
+    def get_result(self, name):
+        return {'name': name, 'mag': np.array([20., 21.]),
+                'n_expected': np.array([1., 2.]),
+                'z': np.array([0.1, 0.2, 0.3]), 'n_z': np.array([3., 2., 1.])}
+
+    def run_batch(self, output, **kwargs):
+        stdout = StringIO()
+        call_command('run_batch', output, models=['mn2'], processes=1,
+                     n_mag=3, stdout=stdout, stderr=StringIO(), **kwargs)
+        return stdout.getvalue()
+
+    def test_csv_resume(self):
+        filename = os.path.join(self.out_dir, 'out.csv')
+        writer = _CSVWriter(filename)
+        self.assertEqual(writer.get_done(), set())
+        writer.write(self.get_result('m0'))
+        writer.write(self.get_result('m1'))
+        writer.close()
+        with open(filename) as f:
+            content = f.read()
+
+        # Interrupted while writing m2
+        with open(filename, 'a') as f:
+            f.write('m2,n_expected,20.0,1.0\r\nm2,n_exp')
+
+        writer = _CSVWriter(filename)
+        self.assertEqual(writer.get_done(), set(['m0', 'm1']))
+        writer.close()
+        with open(filename) as f:
+            self.assertEqual(f.read(), content)
+
+        lines = content.splitlines()
+        self.assertEqual(lines[0], 'model,quantity,x,value')
+        self.assertEqual(len(lines), 1 + 2 * (2 + 3 + 1))
+        self.assertEqual(lines[6], 'm0,done,,')
+
+    def test_csv_not_output(self):
+        filename = os.path.join(self.out_dir, 'other.csv')
+        with open(filename, 'w') as f:
+            f.write('a,b\n1,2\n')
+        with self.assertRaises(CommandError):
+            _CSVWriter(filename)
+        with open(filename) as f:
+            self.assertEqual(f.read(), 'a,b\n1,2\n')
+
+    def test_npz_resume(self):
+        directory = os.path.join(self.out_dir, 'npz')
+        writer = _NPZWriter(directory)
+        writer.write(self.get_result('m0'))
+        writer.write(self.get_result('m/1'))
+        # Left over from an interrupted write
+        with open(os.path.join(directory, 'm2.npz.tmp'), 'w') as f:
+            f.write('PK')
+
+        self.assertEqual(_NPZWriter(directory).get_done(),
+                         set(['m0', 'm/1']))
+
+    def test_run_batch(self):
+        filename = os.path.join(self.out_dir, 'out.csv')
+        writer = _CSVWriter(filename)
+        writer.close()
+        with open(filename, 'a') as f:
+            f.write('mn2,n_expected,20.0,1.0\r\nmn2,n_exp')
+
+        self.assertIn('1 models, 0 done, 1 to run', self.run_batch(filename))
+        with open(filename) as f:
+            lines = f.read().splitlines()
+        # Only the rows of the new run (n_mag = 3)
+        self.assertEqual(len([l for l in lines
+                              if l.startswith('mn2,n_exp')]), 3)
+        self.assertEqual(lines[-1], 'mn2,done,,')
+
+        self.assertIn('1 models, 1 done, 0 to run', self.run_batch(filename))
+
+        directory = os.path.join(self.out_dir, 'npz')
+        self.assertIn('0 done', self.run_batch(directory, format='npz'))
+        self.assertIn('1 done', self.run_batch(directory, format='npz'))
+
+class ResponseCacheTests(ViewTestCase):
+    """Keys and ETags of the cached responses
+    """
+    urls = ['/ratecalc/lightcurve/mn2/', '/ratecalc/expected/mn2/',
+            '/ratecalc/redshift/mn2/']
+
+    def get_post_data(self, url):
+        # The GET views do not scale the amplitude
+        data = super(ResponseCacheTests, self).get_post_data(url)
+        data.pop('scale_amplitude', None)
+        return data
+
+    def test_canonical(self):
+        self.assertEqual(canonical(u'ab'), canonical('ab'))
+        self.assertEqual(repr(canonical(1)), repr(canonical(1.)))
+        self.assertEqual(repr(canonical(np.float32(0.1))),
+                         repr(canonical(0.1)))
+        self.assertEqual(repr(canonical(-0.)), repr(canonical(0.)))
+        self.assertEqual(canonical(24.000000001), canonical(24.))
+        self.assertNotEqual(canonical(24.0001), canonical(24.))
+        self.assertIs(canonical(True), True)
+        self.assertIsNone(canonical(None))
+        self.assertEqual(canonical({'b': [1, 2.], u'a': np.array([3.])}),
+                         (('a', (3.,)), ('b', (1., 2.))))
+
+    def test_response_key(self):
+        key = get_response_key('expected', {'band': 'bessellb', 'n': 1,
+                                            'mag': [20., 21.]})
+        self.assertEqual(get_response_key('expected',
+                                          {u'mag': (20, 21.), 'n': 1.,
+                                           'band': u'bessellb'}), key)
+        self.assertNotEqual(get_response_key('redshift',
+                                             {'band': 'bessellb', 'n': 1,
+                                              'mag': [20., 21.]}), key)
+        self.assertNotEqual(get_response_key('expected',
+                                             {'band': 'bessellv', 'n': 1,
+                                              'mag': [20., 21.]}), key)
+
+    def test_get_post(self):
+        for url in self.urls:
+            data = self.get_post_data(url)
+            for suffix in ['json/', 'export/csv/']:
+                etag = self.client.get(url + suffix)['ETag']
+                self.assertEqual(self.client.post(url + suffix,
+                                                  data)['ETag'], etag)
+
+            data['band'] = 'bessellb'
+            self.assertNotEqual(self.client.post(url + 'json/',
+                                                 data)['ETag'], etag)
+
+    def test_not_modified(self):
+        for url in self.urls:
+            etag = self.client.get(url + 'json/')['ETag']
+            response = self.client.get(url + 'json/', HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response['ETag'], etag)
+            self.assertEqual(self.client.get(
+                url + 'json/', HTTP_IF_NONE_MATCH='W/' + etag
+            ).status_code, 304)
+            self.assertEqual(self.client.get(
+                url + 'json/', HTTP_IF_NONE_MATCH='"other", ' + etag
+            ).status_code, 304)
+            self.assertEqual(self.client.get(
+                url + 'json/', HTTP_IF_NONE_MATCH='"other"'
+            ).status_code, 200)
+            self.assertEqual(self.client.post(
+                url + 'json/', self.get_post_data(url),
+                HTTP_IF_NONE_MATCH=etag
+            ).status_code, 200)
+
+            # The HTML pages have weak ETags
+            etag = self.client.get(url)['ETag']
+            self.assertTrue(etag.startswith('W/'))
+            self.assertEqual(self.client.get(
+                url, HTTP_IF_NONE_MATCH=etag
+            ).status_code, 304)
+
+    def test_model_file(self):
+        url = '/ratecalc/expected/mn2/json/'
+        etag = self.client.get(url)['ETag']
+        stat = os.stat(self.sed_file)
+        os.utime(self.sed_file, (stat.st_atime, stat.st_mtime + 10.))
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
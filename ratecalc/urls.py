@@ -4,10 +4,23 @@ from ratecalc import views
 urlpatterns = [
     url(r'^$', views.index, name='index'),
     url(r'^about/', views.about, name='about'),
+    url(r'^stats/$', views.show_stats, name='show_stats'),
     url(r'^lightcurve/(?P<tm_name>[\w\-]+)/$',
         views.show_lightcurve, name='show_lightcurve'),
+    url(r'^lightcurve/(?P<tm_name>[\w\-]+)/json/$',
+        views.lightcurve_json, name='lightcurve_json'),
+    url(r'^lightcurve/(?P<tm_name>[\w\-]+)/export/(?P<fmt>csv|npy|bin)/$',
+        views.lightcurve_export, name='lightcurve_export'),
     url(r'^expected/(?P<tm_name>[\w\-]+)/$',
         views.show_expected, name='show_expected'),
+    url(r'^expected/(?P<tm_name>[\w\-]+)/json/$',
+        views.expected_json, name='expected_json'),
+    url(r'^expected/(?P<tm_name>[\w\-]+)/export/(?P<fmt>csv|npy|bin)/$',
+        views.expected_export, name='expected_export'),
     url(r'^redshift/(?P<tm_name>[\w\-]+)/$',
         views.show_redshift, name='show_redshift'),
+    url(r'^redshift/(?P<tm_name>[\w\-]+)/json/$',
+        views.redshift_json, name='redshift_json'),
+    url(r'^redshift/(?P<tm_name>[\w\-]+)/export/(?P<fmt>csv|npy|bin)/$',
+        views.redshift_export, name='redshift_export'),
 ]
\ No newline at end of file
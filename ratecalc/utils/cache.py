@@ -0,0 +1,254 @@
+import os
+import hashlib
+import tempfile
+import zipfile
+import numpy as np
+import sncosmo
+
+from ratecalc_django.settings import CACHE_DIR, TABLE_CACHE_MAX_SIZE
+
+CACHE_VERSION = 1
+
+class TableCache(object):
+    """On-disk cache of numpy tables addressed by a hash of their inputs.
+
+    Each entry is a single .npz file in directory. Entries written with a
+    different cache version are ignored. If the total size of the cache
+    exceeds max_size bytes, the least recently used entries are removed.
+    """
+    def __init__(self, directory, max_size=TABLE_CACHE_MAX_SIZE,
+                 version=CACHE_VERSION):
+        """
+        """
+        self.directory = directory
+        self.max_size = max_size
+        self.version = version
+
+    def get_key(self, *args):
+        """Hash of the version and the repr of args
+        """
+        return hashlib.md5(repr((self.version,) + args)).hexdigest()
+
+    def _get_path_(self, key):
+        return os.path.join(self.directory, '%s.npz'%key)
+
+    def get(self, key):
+        """Return dict of arrays stored under key or None
+        """
+        path = self._get_path_(key)
+        if not os.path.exists(path):
+            return None
+
+        try:
+            with np.load(path) as data:
+                out = {k: data[k] for k in data.files}
+        except (IOError, ValueError, zipfile.BadZipfile):
+            return None
+
+        if out.pop('_version', None) != self.version:
+            return None
+
+        # Mark as recently used
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        return out
+
+    def set(self, key, **arrays):
+        """Store arrays under key (written atomically through a unique
+        temporary file, so concurrent writers of the same key do not
+        interfere). Failures to write are ignored.
+        """
+        try:
+            _makedirs_(self.directory)
+            _write_atomic_(self._get_path_(key),
+                           lambda f: np.savez(f, _version=self.version,
+                                              **arrays))
+        except (IOError, OSError):
+            return
+
+        self._evict_()
+
+    def _evict_(self):
+        """Remove least recently used entries until the cache fits max_size
+        """
+        if self.max_size is None:
+            return
+
+        entries = []
+        for filename in os.listdir(self.directory):
+            if filename.endswith('.npz'):
+                path = os.path.join(self.directory, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(e[1] for e in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        """Remove all entries
+        """
+        if os.path.isdir(self.directory):
+            for filename in os.listdir(self.directory):
+                if filename.endswith('.npz'):
+                    os.remove(os.path.join(self.directory, filename))
+
+def _makedirs_(directory):
+    """
+    """
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+
+def _write_atomic_(path, write):
+    """Call write(f) on a unique temporary file in the directory of path and
+    rename it to path
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.rename(tmp_path, path)
+    except:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+_table_cache = None
+
+def get_table_cache():
+    """Default cache of magnitude-redshift tables in CACHE_DIR
+    """
+    global _table_cache
+    if _table_cache is None:
+        _table_cache = TableCache(os.path.join(CACHE_DIR, 'mz_tables'))
+
+    return _table_cache
+
+def _save_npy_(path, arr):
+    """Write arr to path atomically (see _write_atomic_)
+    """
+    _write_atomic_(path, lambda f: np.save(f, arr))
+
+def read_cached(filename, reader, names, directory, mmap_mode='r'):
+    """Read the arrays names from a text file with reader (returning a
+    tuple of arrays) using a binary sidecar cache: the arrays are stored as
+    .npy files in directory and read with mmap_mode. Entries are keyed by
+    the path of the file and invalidated when its modification time or
+    size changes. Failures to write the cache are ignored.
+
+    Note that only arrays used as they are stay memory-mapped; e.g.
+    TimeSeriesSource copies the flux into its spline coefficients (or its
+    interpolation grid), so the cache saves the parsing, not the memory.
+    """
+    path = os.path.abspath(filename)
+    stat = os.stat(path)
+    prefix = hashlib.md5(path).hexdigest()
+    stamp = hashlib.md5(repr((CACHE_VERSION, stat.st_mtime,
+                              stat.st_size))).hexdigest()
+    paths = [os.path.join(directory, '%s_%s.%s.npy'%(prefix, stamp, name))
+             for name in names]
+
+    if all(os.path.exists(p) for p in paths):
+        try:
+            return tuple(np.load(p, mmap_mode=mmap_mode) for p in paths)
+        except (IOError, ValueError):
+            pass
+
+    arrays = reader(filename)
+
+    try:
+        _makedirs_(directory)
+
+        # Remove entries of older versions of the file
+        for name in os.listdir(directory):
+            if name.startswith(prefix) and not name.startswith(
+                    '%s_%s'%(prefix, stamp)):
+                try:
+                    os.remove(os.path.join(directory, name))
+                except OSError:
+                    pass
+
+        for p, arr in zip(paths, arrays):
+            _save_npy_(p, arr)
+    except (IOError, OSError):
+        pass
+
+    return tuple(arrays)
+
+def read_griddata_cached(filename, directory=None, mmap_mode='r'):
+    """sncosmo.read_griddata_ascii with a binary sidecar cache in directory
+    (default CACHE_DIR/sed, see read_cached)
+    """
+    if directory is None:
+        directory = os.path.join(CACHE_DIR, 'sed')
+
+    return read_cached(filename, sncosmo.read_griddata_ascii,
+                       ['phase', 'wave', 'flux'], directory,
+                       mmap_mode=mmap_mode)
+
+def get_source_id(source):
+    """Identity of an sncosmo source: class, name and version and, for
+    sources without a name (e.g. loaded from a file), a hash of their data
+    (incl. the flux mode of TimeSeriesSource)
+    """
+    grid_id = getattr(source, '_grid_id', None)
+    if source.name is not None:
+        return (source.__class__.__name__, source.name, source.version,
+                grid_id)
+
+    md5 = hashlib.md5(repr(grid_id))
+    for attr in ['_phase', '_wave']:
+        if hasattr(source, attr):
+            md5.update(np.ascontiguousarray(getattr(source, attr)).tostring())
+    if hasattr(source, '_model_flux'):
+        for arr in (source._model_flux.get_knots()
+                    + (source._model_flux.get_coeffs(),)):
+            md5.update(np.ascontiguousarray(arr).tostring())
+
+    return (source.__class__.__name__, md5.hexdigest())
+
+def get_bandpass_id(band, magsys):
+    """Identity of a bandpass and magnitude system: name and a hash of the
+    transmission curve and of the zero-point flux in the band, so entries
+    computed with a different version of a (re-registered) filter are not
+    reused
+    """
+    b = sncosmo.get_bandpass(band)
+    md5 = hashlib.md5(repr(float(sncosmo.get_magsystem(magsys)
+                                 .zpbandflux(b))))
+    for arr in [b.wave, b.trans]:
+        md5.update(np.ascontiguousarray(arr, dtype=float).tostring())
+
+    return (b.name, magsys, md5.hexdigest())
+
+def get_model_id(model):
+    """Identity of an sncosmo model: its source, effects and parameters
+    (except z and t0)
+    """
+    params = tuple((name, float(value))
+                   for name, value in zip(model.param_names, model.parameters)
+                   if name not in ['z', 't0'])
+    effects = tuple((effect.__class__.__name__, name, frame)
+                    for effect, name, frame in zip(model._effects,
+                                                   model._effect_names,
+                                                   model._effect_frames))
+
+    return (get_source_id(model._source), effects, params)
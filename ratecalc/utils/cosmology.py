@@ -0,0 +1,110 @@
+import numpy as np
+import threading
+
+from scipy.interpolate import InterpolatedUnivariateSpline as Spline1d
+from scipy.optimize import newton
+
+from collections import OrderedDict as odict
+
+_max_tables = 8
+_tables = odict()
+_tables_lock = threading.Lock()
+
+class CosmologyTable(object):
+    """Dense lookup tables of luminosity distance and comoving volume for an
+    astropy cosmology. The astropy integrations are done once on a
+    logarithmic redshift grid; lookups are cubic splines in log-log space.
+    Redshifts outside the table are passed on to astropy.
+
+    All distances are in Mpc and volumes in Mpc^3 (plain floats/arrays).
+    """
+    def __init__(self, cosmo, z_min=1e-6, z_max=30., n=500):
+        """
+        """
+        self.cosmo = cosmo
+        self.z_min = z_min
+        self.z_max = z_max
+
+        z = np.logspace(np.log10(z_min), np.log10(z_max), n)
+        log_z = np.log(z)
+        log_d_l = np.log(cosmo.luminosity_distance(z).value)
+        log_v_c = np.log(cosmo.comoving_volume(z).value)
+
+        self._d_l_min = np.exp(log_d_l[0])
+        self._d_l_max = np.exp(log_d_l[-1])
+
+        self._f_d_l = Spline1d(log_z, log_d_l)
+        self._f_v_c = Spline1d(log_z, log_v_c)
+        self._f_z = Spline1d(log_d_l, log_z)
+
+    def _lookup_(self, x, x_min, x_max, f, fallback):
+        """Evaluate spline f (log-log) inside [x_min, x_max], fallback outside
+        and return 0 for x <= 0
+        """
+        x = np.asarray(x, dtype=float)
+        out = np.zeros(x.shape)
+
+        mask = (x >= x_min) & (x <= x_max)
+        out[mask] = np.exp(f(np.log(x[mask])))
+
+        mask = (x > 0) & ~mask
+        if np.any(mask):
+            out[mask] = fallback(x[mask])
+
+        return out if out.ndim > 0 else float(out)
+
+    def luminosity_distance(self, z):
+        """Luminosity distance in Mpc
+        """
+        return self._lookup_(z, self.z_min, self.z_max, self._f_d_l,
+                             lambda z_: self.cosmo.luminosity_distance(z_).value)
+
+    def comoving_volume(self, z):
+        """Comoving volume (full sky) in Mpc^3
+        """
+        return self._lookup_(z, self.z_min, self.z_max, self._f_v_c,
+                             lambda z_: self.cosmo.comoving_volume(z_).value)
+
+    def distmod(self, z):
+        """Distance modulus
+        """
+        return 5 * np.log10(self.luminosity_distance(z)) + 25
+
+    def z_at_luminosity_distance(self, d_l):
+        """Inverse of luminosity_distance (d_l in Mpc)
+        """
+        def _fallback(d_l_):
+            f_newton = lambda z, d: self.cosmo.luminosity_distance(z).value - d
+            return np.array([newton(f_newton, d * self.cosmo.H0.value / 3e5,
+                                    args=(d,))
+                             for d in d_l_])
+
+        return self._lookup_(d_l, self._d_l_min, self._d_l_max, self._f_z,
+                             _fallback)
+
+def get_cosmo_key(cosmo):
+    """Key of a cosmology based on its parameters (not its name)
+    """
+    m_nu = (tuple(np.atleast_1d(cosmo.m_nu.value))
+            if cosmo.has_massive_nu else None)
+
+    return (cosmo.__class__.__name__, cosmo.H0.value, cosmo.Om0, cosmo.Ode0,
+            cosmo.Tcmb0.value, cosmo.Neff, m_nu, cosmo.Ob0,
+            getattr(cosmo, 'w0', None), getattr(cosmo, 'wa', None))
+
+def get_cosmology_table(cosmo):
+    """Get the CosmologyTable of cosmo from a process-wide LRU cache (holding
+    at most _max_tables tables)
+    """
+    key = get_cosmo_key(cosmo)
+
+    with _tables_lock:
+        if key in _tables:
+            table = _tables.pop(key)
+        else:
+            table = CosmologyTable(cosmo)
+            while len(_tables) >= _max_tables:
+                _tables.popitem(last=False)
+        _tables[key] = table
+
+    return table
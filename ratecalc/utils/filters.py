@@ -1,13 +1,37 @@
 import os
+import threading
 import numpy as np
 import sncosmo
 
-from ratecalc_django.settings import BASE_DIR
+from ratecalc_django.settings import BASE_DIR, CACHE_DIR
+from cache import read_cached
+
+FILTER_DIR = os.path.join(BASE_DIR, 'ratecalc/utils/filters')
+
+_registered = {}
+_registered_lock = threading.Lock()
+
+def _read_filter_(filename):
+    data = np.genfromtxt(filename)
+    return data[:,0], data[:,1]
 
 def load_filters():
-    filter_dir = os.path.join(BASE_DIR, 'ratecalc/utils/filters')
-    for filename in os.listdir(filter_dir):
-        data = np.genfromtxt('%s/%s'%(filter_dir, filename))
-        name = filename.split('.')[0]
-        band = sncosmo.Bandpass(data[:,0], data[:,1], name=name)
-        sncosmo.registry.register(band, force=True)
\ No newline at end of file
+    """Register the bandpasses in FILTER_DIR with sncosmo. Files are only
+    read (from the binary cache in CACHE_DIR/filters if possible) and
+    registered again if their modification time or size changed since they
+    were last registered in this process.
+    """
+    with _registered_lock:
+        for filename in os.listdir(FILTER_DIR):
+            path = os.path.join(FILTER_DIR, filename)
+            stat = os.stat(path)
+            if _registered.get(filename) == (stat.st_mtime, stat.st_size):
+                continue
+
+            wave, trans = read_cached(path, _read_filter_, ['wave', 'trans'],
+                                      os.path.join(CACHE_DIR, 'filters'),
+                                      mmap_mode=None)
+            name = filename.split('.')[0]
+            band = sncosmo.Bandpass(wave, trans, name=name)
+            sncosmo.registry.register(band, force=True)
+            _registered[filename] = (stat.st_mtime, stat.st_size)
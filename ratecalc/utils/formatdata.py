@@ -1,32 +1,116 @@
+import json
+import struct
+import numpy as np
+
+# Rows formatted or packed at once by the iter_* functions
+CHUNK_SIZE = 10000
+
+# Magic string and version of the binary export format (see iter_binary)
+BINARY_MAGIC = 'RCBIN'
+BINARY_VERSION = 1
+
 def format_lightcurve_data(phase, mags, labels, log_t=False):
     if log_t is True:
         format_str = '{:>8.3e}   '
     else:
         format_str = '{:>8.3f}   '
     format_str += '   '.join(['{:>7.2f}' for k in range(len(labels))])
-    out = ['# time    ' + '    '.join(labels)]
-    for k in xrange(len(phase)):
-        data = [phase[k]] + [m[k] for m in mags]
-        out.append(format_str.format(*data))
 
-    return '\n'.join(out)
+    return format_table(get_table(phase, mags), format_str,
+                        '# time    ' + '    '.join(labels))
 
 
 def format_expected_data(mag, n, labels):
     format_str = '{:>7.2f}   '
     format_str += '   '.join(['{:>7.2e}' for k in range(len(n))])
-    out = ['# m_lim    ' + '    '.join(['n_%s'%(l.replace(' ', '_'))
-                                                for l in labels])]
-    for k in xrange(len(mag)):
-        data = [mag[k]] + [n_[k] for n_ in n]
-        out.append(format_str.format(*data))
-
-    return '\n'.join(out)
-        
+
+    header = '# m_lim    ' + '    '.join(['n_%s'%(l.replace(' ', '_'))
+                                          for l in labels])
+
+    return format_table(get_table(mag, n), format_str, header)
+
 def format_redshift_data(z, n):
-    format_str = '{:>5.3f}   {:>7.2e}'
-    out = ['# z_bincenter n_transient']
-    for k in xrange(len(z)):
-        out.append(format_str.format(z[k], n[k]))
+    return format_table(get_table(z, [n]), '{:>5.3f}   {:>7.2e}',
+                        '# z_bincenter n_transient')
+
+def get_table(x, ys):
+    """Array of shape (len(x), 1 + len(ys)) with columns x and ys
+    """
+    return np.column_stack([x] + list(ys)).astype(float)
+
+def _to_percent_format_(format_str):
+    """Translate the str.format fields used here ('{:>8.3f}') to
+    %-formatting ('%8.3f'), which can format a whole chunk of rows at once
+    """
+    return format_str.replace('{:>', '%').replace('}', '')
+
+def iter_table(data, format_str, header=None, chunk_size=CHUNK_SIZE):
+    """Lines of the formatted table (format_str in str.format syntax for one
+    row), yielded in strings of chunk_size rows each ending with a newline
+    """
+    row_format = _to_percent_format_(format_str)
+    if header is not None:
+        yield header + '\n'
+
+    for k in xrange(0, len(data), chunk_size):
+        chunk = data[k:k+chunk_size]
+        yield ('\n'.join([row_format] * len(chunk))
+               %tuple(chunk.ravel())) + '\n'
+
+def format_table(data, format_str, header=None):
+    """Formatted table as a single string (see iter_table)
+    """
+    return ''.join(iter_table(data, format_str, header))[:-1]
+
+def iter_csv(data, columns, chunk_size=CHUNK_SIZE):
+    """CSV with a header line of column names; floats are written with full
+    precision ('%.17g')
+    """
+    return iter_table(data, ','.join(['{:>.17g}'] * data.shape[1]),
+                      ','.join(columns), chunk_size)
+
+def iter_npy(data, chunk_size=CHUNK_SIZE):
+    """Table in the .npy format (float64, C order), written in chunks
+    """
+    data = np.asarray(data, dtype='<f8')
+    header = {'descr': '<f8', 'fortran_order': False, 'shape': data.shape}
+    header = repr(header)
+    # Pad the header such that the data starts at a multiple of 64 bytes
+    n_pad = 63 - (10 + len(header)) % 64
+    header += ' ' * n_pad + '\n'
+
+    yield '\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header
+    for k in xrange(0, len(data), chunk_size):
+        yield np.ascontiguousarray(data[k:k+chunk_size]).tostring()
+
+def iter_binary(data, columns, dtype='<f4', chunk_size=CHUNK_SIZE):
+    """Compact binary table: BINARY_MAGIC, version (uint8), length of the
+    JSON header (uint32, little endian), the JSON header (columns, dtype and
+    number of rows) and the rows of the table in dtype
+    """
+    header = json.dumps({'columns': list(columns), 'dtype': dtype,
+                         'n_rows': len(data)})
+
+    yield (BINARY_MAGIC + struct.pack('<BI', BINARY_VERSION, len(header))
+           + header)
+    for k in xrange(0, len(data), chunk_size):
+        yield np.ascontiguousarray(data[k:k+chunk_size],
+                                   dtype=dtype).tostring()
+
+def read_binary(filename):
+    """Read a table written by iter_binary
+
+    returns (columns, data)
+    """
+    with open(filename, 'rb') as f:
+        magic = f.read(len(BINARY_MAGIC))
+        if magic != BINARY_MAGIC:
+            raise ValueError('%s is not a ratecalc binary table'%filename)
+        version, n_header = struct.unpack('<BI', f.read(5))
+        if version != BINARY_VERSION:
+            raise ValueError('Unsupported version %i'%version)
+        header = json.loads(f.read(n_header))
+        data = np.fromfile(f, dtype=header['dtype'])
 
-    return '\n'.join(out)
\ No newline at end of file
+    return header['columns'], data.reshape(header['n_rows'],
+                                           len(header['columns']))
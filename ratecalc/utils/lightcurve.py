@@ -1,7 +1,9 @@
 import numpy as np
 
 from filters import load_filters
-from scipy.interpolate import InterpolatedUnivariateSpline as Spline1d
+from rates import bandflux_grid, check_bands
+from scipy.interpolate import (InterpolatedUnivariateSpline as Spline1d,
+                               make_interp_spline)
 
 def get_lightcurves(model, bands, magsys, t_range=None, log_t=False, n_points=100):
     load_filters()
@@ -23,11 +25,22 @@ def get_lightcurves(model, bands, magsys, t_range=None, log_t=False, n_points=10
     else:
         phase = np.logspace(np.log10(t_range[0]), np.log10(t_range[1]), n_points)
 
-    mags = []
-    for b, ms in zip(bands, magsys):    
-        m_interp = model.bandmag(b, ms, p_interp)
-        mask = ~np.isnan(m_interp)
-        f_interp = Spline1d(p_interp[mask], m_interp[mask])
-        mags.append(f_interp(phase))
-        
-    return phase, mags
\ No newline at end of file
+    # All bands are integrated from a single evaluation of the SED
+    z = model.get('z')
+    check_bands(model, bands)
+    f_interp = bandflux_grid(model, bands, [z],
+                             (p_interp - model.get('t0')) / (1 + z),
+                             magsys=magsys)[:, 0]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        m_interp = -2.5 * np.log10(f_interp) + 30
+
+    # One spline for all bands without NaNs (same interpolant as Spline1d)
+    mask = ~np.isnan(m_interp)
+    full = np.all(mask, axis=1)
+    mags = np.empty((len(bands), len(phase)))
+    if np.any(full):
+        mags[full] = make_interp_spline(p_interp, m_interp[full].T)(phase).T
+    for k in np.where(~full)[0]:
+        mags[k] = Spline1d(p_interp[mask[k]], m_interp[k, mask[k]])(phase)
+
+    return phase, list(mags)
@@ -1,11 +1,89 @@
 import numpy as np
 
+import inspect
+import hashlib
+import threading
+import functools
 import cStringIO
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
 
+from collections import OrderedDict as odict
+
+from cache import TableCache
+from ratecalc_django.settings import (PLOT_CACHE_SIZE, PLOT_CACHE_DIR,
+                                      PLOT_CACHE_MAX_SIZE)
+
+_plots = odict()
+_plots_lock = threading.Lock()
+_plot_disk_cache = (TableCache(PLOT_CACHE_DIR, max_size=PLOT_CACHE_MAX_SIZE)
+                    if PLOT_CACHE_DIR is not None else None)
+
+def _update_hash_(md5, obj):
+    """Add obj (arrays, lists/tuples of them and other objects by their
+    repr) to the hash md5
+    """
+    if isinstance(obj, np.ndarray):
+        md5.update(repr((obj.dtype.str, obj.shape)))
+        md5.update(np.ascontiguousarray(obj).tostring())
+    elif isinstance(obj, (list, tuple)):
+        md5.update('%s%i'%(obj.__class__.__name__, len(obj)))
+        for item in obj:
+            _update_hash_(md5, item)
+    else:
+        md5.update(repr(obj))
+
+def get_plot_key(func, *args, **kwargs):
+    """Hash of the name of the plot function, its arguments (incl. the
+    defaults) and the matplotlib version
+    """
+    md5 = hashlib.md5(repr((func.__name__, matplotlib.__version__)))
+    _update_hash_(md5, sorted(inspect.getcallargs(func, *args,
+                                                  **kwargs).items()))
+
+    return md5.hexdigest()
+
+def cached_plot(func):
+    """Cache the SVG strings returned by a plot function in memory (the
+    PLOT_CACHE_SIZE most recently used) and, if PLOT_CACHE_DIR is set, on
+    disk, so identical plots are only drawn once
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        key = get_plot_key(func, *args, **kwargs)
+
+        with _plots_lock:
+            svg = _plots.pop(key, None)
+            if svg is not None:
+                _plots[key] = svg
+                return svg
+
+        if _plot_disk_cache is not None:
+            entry = _plot_disk_cache.get(key)
+            if entry is not None:
+                svg = str(entry['svg'])
+
+        if svg is None:
+            svg = func(*args, **kwargs)
+            if _plot_disk_cache is not None:
+                # A failed cache write must not break the rendering
+                try:
+                    _plot_disk_cache.set(key, svg=np.array(svg))
+                except (IOError, OSError):
+                    pass
+
+        with _plots_lock:
+            _plots[key] = svg
+            while len(_plots) > PLOT_CACHE_SIZE:
+                _plots.popitem(last=False)
+
+        return svg
+
+    return wrapper
+
+@cached_plot
 def plot_lightcurve(phase, mags, labels, mag_cut=8, log_t=False):
     fig = plt.Figure()
     ax = fig.add_subplot(111)
@@ -36,6 +114,7 @@ def plot_lightcurve(phase, mags, labels, mag_cut=8, log_t=False):
     
     return make_svg_str(fig)
 
+@cached_plot
 def plot_expected(mag, n, labels):
     fig = plt.Figure()
     ax = fig.add_subplot(111)
@@ -56,6 +135,7 @@ def plot_expected(mag, n, labels):
     
     return make_svg_str(fig)
 
+@cached_plot
 def plot_redshift(z, n, width=0.01):
     fig = plt.Figure()
     ax = fig.add_subplot(111)
@@ -0,0 +1,205 @@
+import os
+import numpy as np
+import threading
+
+from collections import OrderedDict as odict
+
+from cosmology import get_cosmology_table, get_cosmo_key
+from ratecalc_django.settings import BASE_DIR
+
+_max_rate_models = 32
+_cached_rate_models = odict()
+_rate_models_lock = threading.Lock()
+
+class RateModel(object):
+    """Volumetric rate r(z) = r0 * shape(z) in Mpc^-3 yr^-1 (rest frame)
+    with shape(0) = 1.
+
+    Rate models can be used wherever a rate function is expected. In
+    addition, they tabulate the cumulative number of transients per
+    observer-frame year and full sky,
+
+        N(<z) = int_0^z r(z') / (1 + z') dV/dz' dz',
+
+    once per cosmology on a logarithmic redshift grid, which shell_rate
+    uses instead of evaluating the rate in every bin.
+    """
+    z_min = 1e-5
+    z_max = 10.
+    n_z = 2000
+
+    def __init__(self, r0=3e-5):
+        """
+        """
+        self.r0 = r0
+        self._n_cum = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, z):
+        """
+        """
+        return self.r0 * self.shape(np.asarray(z, dtype=float))
+
+    def shape(self, z):
+        """
+        """
+        raise NotImplementedError
+
+    def _build_n_cum_(self, cosmo, z_max):
+        """Cumulative numbers on a logarithmic grid up to z_max using the
+        midpoint rule on 10 sub-steps per grid step
+        """
+        z = np.append(0., np.logspace(np.log10(self.z_min), np.log10(z_max),
+                                      self.n_z))
+        z_fine = np.append(0., np.logspace(np.log10(self.z_min),
+                                           np.log10(z_max), 10 * self.n_z))
+        z_ctr = 0.5 * (z_fine[1:] + z_fine[:-1])
+        shell_vols = np.diff(get_cosmology_table(cosmo).comoving_volume(z_fine))
+        n_fine = np.append(0., np.cumsum(self(z_ctr) / (1 + z_ctr) * shell_vols))
+
+        return z, np.interp(z, z_fine, n_fine)
+
+    def get_n_cum(self, z, cosmo):
+        """Cumulative number of transients N(<z) per year and full sky
+        (interpolated log-log from the table of cosmo)
+        """
+        z = np.asarray(z, dtype=float)
+        key = get_cosmo_key(cosmo)
+
+        with self._lock:
+            z_tab, n_tab = self._n_cum.get(key, (None, None))
+            if z_tab is None or z.max() > z_tab[-1]:
+                z_tab, n_tab = self._build_n_cum_(
+                    cosmo, max(self.z_max, 2 * z.max())
+                )
+                self._n_cum[key] = (z_tab, n_tab)
+
+        with np.errstate(divide='ignore'):
+            return np.exp(np.interp(np.log(z), np.log(z_tab[1:]),
+                                    np.log(n_tab[1:]), left=-np.inf))
+
+    def __getstate__(self):
+        """Tables are rebuilt after unpickling
+        """
+        state = self.__dict__.copy()
+        state['_n_cum'] = {}
+        del state['_lock']
+
+        return state
+
+    def __setstate__(self, state):
+        """
+        """
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+class ConstantRate(RateModel):
+    """r(z) = r0
+    """
+    def shape(self, z):
+        """
+        """
+        return np.ones(z.shape)
+
+class PowerLawRate(RateModel):
+    """r(z) = r0 * (1 + z)^alpha
+    """
+    def __init__(self, r0=3e-5, alpha=1.5):
+        """
+        """
+        super(PowerLawRate, self).__init__(r0)
+        self.alpha = alpha
+
+    def shape(self, z):
+        """
+        """
+        return (1 + z)**self.alpha
+
+class MadauDickinsonRate(RateModel):
+    """Rate tracking the cosmic star-formation history of Madau & Dickinson
+    (2014), normalized to r0 at z = 0:
+
+        r(z) ~ (1 + z)^a / (1 + ((1 + z) / c)^b)
+    """
+    def __init__(self, r0=3e-5, a=2.7, b=5.6, c=2.9):
+        """
+        """
+        super(MadauDickinsonRate, self).__init__(r0)
+        self.a = a
+        self.b = b
+        self.c = c
+
+    def shape(self, z):
+        """
+        """
+        return ((1 + z)**self.a / (1 + ((1 + z) / self.c)**self.b)
+                * (1 + (1. / self.c)**self.b))
+
+class TabulatedRate(RateModel):
+    """Rate interpolated linearly from a table (constant beyond its ends),
+    normalized to r0 at z = 0. If r0 is None, the tabulated values are used
+    as they are.
+    """
+    def __init__(self, z, rate, r0=None):
+        """
+        """
+        self.z_tab = np.asarray(z, dtype=float)
+        self.rate_tab = np.asarray(rate, dtype=float)
+        self._rate_0 = np.interp(0., self.z_tab, self.rate_tab)
+
+        super(TabulatedRate, self).__init__(self._rate_0 if r0 is None else r0)
+
+    @classmethod
+    def from_file(cls, filename, r0=None):
+        """Read table with columns z and rate [Mpc^-3 yr^-1]
+        """
+        z, rate = np.genfromtxt(filename, usecols=(0, 1), unpack=True)
+
+        return cls(z, rate, r0=r0)
+
+    def shape(self, z):
+        """
+        """
+        return np.interp(z, self.z_tab, self.rate_tab) / self._rate_0
+
+def _get_tabulated_rate_(r0=None, rate_file=None):
+    return TabulatedRate.from_file(os.path.join(BASE_DIR, rate_file), r0=r0)
+
+_rate_models = {
+    'constant': ConstantRate,
+    'power-law': PowerLawRate,
+    'madau-dickinson': MadauDickinsonRate,
+    'tabulated': _get_tabulated_rate_,
+    }
+
+def get_rate_model(rate_model='constant', r0=3e-5, **kwargs):
+    """Rate model by name; further keyword arguments are the parameters of
+    the model (e.g. alpha for 'power-law' or rate_file, relative to
+    BASE_DIR, for 'tabulated').
+
+    The models (and thus their tables of N(<z)) are kept in a process-wide
+    LRU cache of at most _max_rate_models entries, keyed by the arguments
+    and the modification time and size of the rate file.
+    """
+    if rate_model not in _rate_models:
+        raise ValueError('Unknown rate model: %s'%rate_model)
+
+    key = (rate_model, r0, sorted(kwargs.items()))
+    if kwargs.get('rate_file') is not None:
+        stat = os.stat(os.path.join(BASE_DIR, kwargs['rate_file']))
+        key += (stat.st_mtime, stat.st_size)
+    key = repr(key)
+
+    with _rate_models_lock:
+        model = _cached_rate_models.pop(key, None)
+        if model is not None:
+            _cached_rate_models[key] = model
+            return model
+
+    model = _rate_models[rate_model](r0=r0, **kwargs)
+    with _rate_models_lock:
+        _cached_rate_models[key] = model
+        while len(_cached_rate_models) > _max_rate_models:
+            _cached_rate_models.popitem(last=False)
+
+    return model
@@ -6,6 +6,7 @@ import matplotlib.pyplot as plt
 import os
 import cPickle
 import copy
+import threading
 
 from scipy.special import erf
 from scipy.integrate import romb, romberg
@@ -22,6 +23,8 @@ from collections import OrderedDict as odict
 
 import sncosmo
 from sncosmo.models import Source
+from sncosmo.utils import integration_grid
+from sncosmo.constants import HC_ERG_AA, MODEL_BANDFLUX_SPACING
 
 import warnings
 
@@ -29,6 +32,15 @@ import warnings
 _cosmo = Planck15
 
 from filters import load_filters
+from cosmology import get_cosmology_table, get_cosmo_key
+from cache import get_model_id, get_bandpass_id
+from ratemodels import RateModel
+
+_max_kernels = 64
+_kernels = odict()
+_kernels_lock = threading.Lock()
+
+_DUST_EFFECTS = (sncosmo.CCM89Dust, sncosmo.OD94Dust, sncosmo.F99Dust)
 
 ############################
 #                          #
@@ -40,8 +52,9 @@ class RateCalculator(object):
     """
     __nature__ = "RateCalculator"
 
-    DO_NOT_SAVE = ['model', 'cosmo',
-                   'f_mag_z', 'f_z_mag', 'ratefunc']
+    DO_NOT_SAVE = ['model', 'cosmo', 'cache',
+                   'f_mag_z', 'f_z_mag', 'ratefunc',
+                   '_z_tab', '_n_tab', '_m_tab', '_n_disp_tab']
 
     def __init__(self, model, band='bessellux',
                  mag_lim=24., magsys='ab',
@@ -55,12 +68,24 @@ class RateCalculator(object):
                  ratefunc=(lambda z: 3e-7),
                  load=False,
                  area=100.,
-                 time=365.25):
+                 time=365.25,
+                 n_table=False,
+                 cache=None,
+                 mz_table=None):
         """
+        n_table: if True, precompute cumulative number tables (see
+                 _build_n_table_) so that get_n_expected and get_z_dist
+                 only need to interpolate
+        cache:   TableCache (see utils/cache.py) to read the magnitude-redshift
+                 table from and store it in
+        mz_table: precomputed full magnitude-redshift table (z, m), e.g. from
+                 MultiBandRateCalculator
         """
         self.model = copy.copy(model)
         self.cosmo = cosmo
         self.ratefunc = ratefunc
+        self.n_table = n_table
+        self.cache = cache
         self.amp_or_x0 = ('amplitude'
                           if 'amplitude' in model.param_names
                           else 'x0')
@@ -80,18 +105,17 @@ class RateCalculator(object):
             else:
                 self.mag_lim = mag_lim + sigma_cut*mag_disp
 
-            if mag_max is not None and type(mag_max) is not tuple:
-                self.mag_max = (mag_max, 'bessellb', 'vega')
-            else:
-                self.mag_max = mag_max
+            self.mag_max = _get_mag_max_(mag_max)
                 
             self.t_above = t_above
             self.t_before = t_before
             
             self.logz_start = logz_start
             self.logz_step = logz_step
-            self._z_interp = np.array([10**self.logz_start])
-            self._m_interp = np.array([self.get_mag(self._z_interp[0])])
+            self._z_grid = None
+            self._m_grid = None
+            if mz_table is not None:
+                self._z_grid, self._m_grid = mz_table
             
             self._update_(new=True)
         else:
@@ -120,6 +144,46 @@ class RateCalculator(object):
         """
         self._set_z_max_()
         self._update_interpolation_(new=new)
+
+        self._z_tab = None
+        if getattr(self, 'n_table', False):
+            self._build_n_table_()
+
+    def _build_n_table_(self, n_z=1000, logz_range=5., n_mag=200):
+        """Precompute the cumulative number of transients N(<z) (for one
+        year and the full sky) on a logarithmic redshift grid up to the
+        redshift of mag_lim. If mag_disp is set, additionally tabulate the
+        dispersion-convolved N(<m_lim) on a grid of limiting magnitudes.
+        """
+        z_tab_max = self.f_z_mag(self.mag_lim)
+        self._z_tab = np.append(0., np.logspace(np.log10(z_tab_max) - logz_range,
+                                                np.log10(z_tab_max), n_z))
+        sh_rate, z = shell_rate(0., z_tab_max, self.ratefunc, cosmo=self.cosmo,
+                                z_binedges=self._z_tab)
+        self._n_tab = np.append(0., np.cumsum(sh_rate))
+
+        self._m_tab = None
+        if self.mag_disp is not None:
+            m_tab_max = self.mag_lim - self.sigma_cut*self.mag_disp
+            if m_tab_max > self._m_interp[0]:
+                self._m_tab = np.linspace(self._m_interp[0], m_tab_max, n_mag)
+                self._n_disp_tab = self._get_n_direct_(self._m_tab, sh_rate,
+                                                       self._z_tab)
+
+    def _interp_n_tab_(self, z):
+        """Interpolate the cumulative table log-log (N ~ z^3 at low z)
+        """
+        with np.errstate(divide='ignore'):
+            return np.exp(np.interp(np.log(z), np.log(self._z_tab[1:]),
+                                    np.log(self._n_tab[1:]), left=-np.inf))
+
+    def _get_n_direct_(self, mags, sh_rate, z_binedges):
+        """Sum the shell rates over bins below the redshift cut of each
+        magnitude, weighted by the fraction of the bin below the cut and by
+        the detection probability (if mag_disp is set)
+        """
+        return get_n_direct(mags, sh_rate, z_binedges, self.f_mag_z,
+                            self.f_z_mag, self.mag_disp, self.sigma_cut)
         
     def _update_interpolation_(self, new=False):
         """
@@ -127,19 +191,54 @@ class RateCalculator(object):
         if not new:
             warnings.warn("Updating magnitude-redshift  interpolation functions")
 
-        edge = False
-        while self._m_interp[-1] < self.mag_lim and not edge:
-            z_new = self._z_interp[-1] * 10**self.logz_step
-            if z_new < self._z_max:
-                self._z_interp = np.append(self._z_interp, z_new)
-                self._m_interp = np.append(self._m_interp,
-                                           self.get_mag(self._z_interp[-1]))
-            else:
-                edge = True
+        if getattr(self, '_m_grid', None) is None:
+            self._z_grid, self._m_grid = self._get_cached_table_()
+        if self._m_grid is None:
+            self._z_grid = self._get_z_grid_()
+            self._m_grid = self.get_mag_grid(self._z_grid)
+            self._set_cached_table_(self._z_grid, self._m_grid)
+
+        # Keep the grid up to and including the first node beyond mag_lim
+        # (nodes without flux end the grid)
+        beyond = ~(self._m_grid < self.mag_lim)
+        if np.any(beyond):
+            n = np.where(beyond)[0][0]
+            if np.isfinite(self._m_grid[n]):
+                n += 1
+        else:
+            n = len(self._m_grid)
+
+        self._z_interp = self._z_grid[:n]
+        self._m_interp = self._m_grid[:n]
             
         self.f_mag_z = Spline1d(self._z_interp, self._m_interp)
         self.f_z_mag = Spline1d(self._m_interp, self._z_interp)
 
+    def _get_cache_key_(self):
+        """Hash of all inputs that determine the magnitude-redshift table
+        """
+        return get_table_key(self.cache, self.model, self.band, self.magsys,
+                             self.t_above, self.t_before, self.mag_max,
+                             self.logz_start, self.logz_step, self.cosmo)
+
+    def _get_cached_table_(self):
+        """Redshifts and magnitudes from the cache or (None, None)
+        """
+        if getattr(self, 'cache', None) is None:
+            return None, None
+
+        table = self.cache.get(self._get_cache_key_())
+        if table is None:
+            return None, None
+
+        return table['z'], table['m']
+
+    def _set_cached_table_(self, z, m):
+        """
+        """
+        if getattr(self, 'cache', None) is not None:
+            self.cache.set(self._get_cache_key_(), z=z, m=m)
+
     def _check_mag_lim_(self, mag):
         """
         """
@@ -155,9 +254,20 @@ class RateCalculator(object):
     def _set_z_max_(self):
         """
         """
-        b = sncosmo.get_bandpass(self.band)
-        self._z_max = b.wave[0] / self.model.minwave() - 1
-                
+        self._z_max = get_z_max(self.model, self.band)
+
+    def _get_z_grid_(self):
+        """Full logarithmic redshift grid up to (excluding) _z_max
+        """
+        return get_z_grid(self._z_max, self.logz_start, self.logz_step)
+
+    def get_mag_grid(self, z):
+        """Batched version of get_mag (see get_mag_z_grid)
+        """
+        return get_mag_z_grid(self.model, self.band, z, magsys=self.magsys,
+                              t_above=self.t_above, t_before=self.t_before,
+                              mag_max=self.mag_max, cosmo=self.cosmo)
+
     def get_mag(self, z):
         """
         """
@@ -168,57 +278,129 @@ class RateCalculator(object):
                 return find_peak_phase_mag(model, self.band, magsys=self.magsys)[1]
             else:
                 p_peak = find_peak_phase_mag(model, self.band, magsys=self.magsys)[0]
-                return model.bandmag(self.band, self.magsys, p_peak - self.t_before)
+                return bandmag(model, self.band, self.magsys,
+                               p_peak - self.t_before)
         else:
             return find_mag_t_above(model, self.band, self.t_above,
                                     magsys=self.magsys)
         
     def get_n_expected(self, mag, nbins=100):
+        """Expected number of transients for limiting magnitude mag.
+
+        mag may be an array, in which case all values are computed from
+        one shell-rate grid up to the largest redshift needed. Its number of
+        bins is nbins times the ratio of the largest and smallest redshift
+        cut (at most 10 * nbins). Bins are weighted by the fraction below the
+        redshift cut of each magnitude and, if mag_disp is set, by the
+        detection probability in a (mag x z) matrix.
+
+        If the calculator has cumulative number tables (n_table=True) the
+        result is interpolated from them instead.
         """
-        """
-        self._check_mag_lim_(mag)
+        mag = np.asarray(mag, dtype=float)
+        mags = np.atleast_1d(mag)
+        self._check_mag_lim_(mags.max())
 
-        z_max = self.f_z_mag(mag + (self.sigma_cut*self.mag_disp
-                                    if self.mag_disp is not None
-                                    else 0))
-        sh_rate, z = shell_rate(0., z_max, self.ratefunc, nbins, self.cosmo,
-                                time=self.time, area=self.area/100.)
+        if self._z_tab is not None and self.mag_disp is None:
+            n = (self._interp_n_tab_(self.f_z_mag(mags))
+                 * self.time / 365.25 * self.area / 100.)
+        elif (self._z_tab is not None and self._m_tab is not None
+              and mags.min() >= self._m_tab[0]):
+            with np.errstate(divide='ignore'):
+                n = (np.exp(np.interp(mags, self._m_tab,
+                                      np.log(self._n_disp_tab)))
+                     * self.time / 365.25 * self.area / 100.)
+        else:
+            z_max = self.f_z_mag(mags + (self.sigma_cut*self.mag_disp
+                                         if self.mag_disp is not None
+                                         else 0))
+            if z_max.min() > 0:
+                nbins *= int(min(np.ceil(z_max.max() / z_max.min()), 10))
+            z_binedges = np.linspace(0., z_max.max(), nbins + 1)
+            sh_rate, z = shell_rate(0., z_max.max(), self.ratefunc,
+                                    cosmo=self.cosmo, time=self.time,
+                                    area=self.area/100., z_binedges=z_binedges)
+            n = self._get_n_direct_(mags, sh_rate, z_binedges)
 
-        if self.mag_disp is not None:
-            sh_rate *= cdf_gauss(self.mag_lim, self.f_mag_z(z), self.mag_disp)
-        
-        return np.sum(sh_rate)
+        return n[0] if mag.ndim == 0 else n
 
-    def get_z_dist(self, mag, z_bin=None, z_step=1e-3):
-        """
+    def get_z_dist(self, mag, z_bin=None, z_step=None, n_sub=10,
+                   log_grid=False):
+        """Binned redshift distribution for limiting magnitude mag.
+
+        z_bin:    bin width or array of bin edges (default: at most 25 bins
+                  up to the redshift of mag_lim)
+        z_step:   step of a linear integration grid (default: n_sub steps
+                  per output bin, or a logarithmic grid with n_sub points
+                  per output bin if log_grid is True)
+
+        The shell rates on the integration grid (or the cumulative table if
+        n_table is set) are summed cumulatively and interpolated at the bin
+        edges, so the cost scales with the number of output bins.
+
+        returns bin centers and numbers of transients
         """
         self._check_mag_lim_(mag)
 
         z_max = self.f_z_mag(self.mag_lim)
+        z_binedges = self._get_z_binedges_(z_max, z_bin)
 
-        nbins = int(z_max / z_step)
+        if self._z_tab is not None:
+            z_int = self._z_tab
+            sh_rate = np.diff(self._n_tab) * self.time / 365.25 * self.area / 100.
+        else:
+            nbins = len(z_binedges) - 1
+            if z_step is not None:
+                z_int = np.linspace(0., z_max,
+                                    max(int(np.ceil(z_max / z_step)), 1) + 1)
+            elif log_grid:
+                z_int = np.append(0., np.logspace(np.log10(z_max) - 4,
+                                                  np.log10(z_max),
+                                                  n_sub * nbins))
+            else:
+                z_out = np.unique(np.concatenate((
+                    [0.], z_binedges[(z_binedges > 0) & (z_binedges < z_max)],
+                    [z_max]
+                )))
+                z_int = np.append(
+                    (z_out[:-1, None] + np.diff(z_out)[:, None]
+                     * np.arange(n_sub)[None, :] / float(n_sub)).ravel(),
+                    z_max
+                )
+
+            sh_rate, z = shell_rate(0., z_max, self.ratefunc, cosmo=self.cosmo,
+                                    time=self.time, area=self.area/100.,
+                                    z_binedges=z_int)
 
-        sh_rate, z = shell_rate(0., nbins*z_step, self.ratefunc, nbins, self.cosmo,
-                                time=self.time, area=self.area/100.)
-        
         if self.mag_disp is not None:
-            sh_rate *= cdf_gauss(mag, self.f_mag_z(z), self.mag_disp)
-
-        z_bin = 1e-3
-        nbins = int(z_max / z_bin)
-        multipliers = [2, 2.5, 2]
-        k = 0
-        while nbins > 25:
-            z_bin *= multipliers[k%len(multipliers)]
-            k += 1
-            nbins = int(z_max / z_bin)     
-            
-        z_binedges = np.arange(0, z_max+z_bin, z_bin)    
-        n = np.array([np.sum(sh_rate[(z >= z0) & (z < z1)])
-                      for z0, z1 in zip(z_binedges[:-1], z_binedges[1:])])
-        
-        return 0.5 * (z_binedges[1:] + z_binedges[:-1]), n
-            
+            z_ctr = 0.5 * (z_int[1:] + z_int[:-1])
+            sh_rate = sh_rate * cdf_gauss(mag, self.f_mag_z(z_ctr),
+                                          self.mag_disp)
+
+        n_cum = np.interp(z_binedges, z_int, np.append(0., np.cumsum(sh_rate)))
+
+        return 0.5 * (z_binedges[1:] + z_binedges[:-1]), np.diff(n_cum)
+
+    def _get_z_binedges_(self, z_max, z_bin=None):
+        """Output bin edges from bin width or edges z_bin. By default the bin
+        width is chosen from 1e-3 x (2, 2.5, 2, ...) such that there are at
+        most 25 bins up to z_max.
+        """
+        if z_bin is None:
+            z_bin = 1e-3
+            nbins = int(z_max / z_bin)
+            multipliers = [2, 2.5, 2]
+            k = 0
+            while nbins > 25:
+                z_bin *= multipliers[k%len(multipliers)]
+                k += 1
+                nbins = int(z_max / z_bin)
+
+        if np.ndim(z_bin) == 0:
+            return np.arange(0, z_max+z_bin, z_bin)
+        else:
+            return np.asarray(z_bin, dtype=float)
+
     def _scale_model_(self, z):
         """Set the model to a certain redshift and adjust its amplitude to
         the luminosity distance. Assumes amplitude = 1 correspond to 10 pc
@@ -227,14 +409,163 @@ class RateCalculator(object):
         
         model.set(z=z)
         if self.mag_max is None:
-            d_l = self.cosmo.luminosity_distance(z).value * 1e5
+            d_l = get_cosmology_table(self.cosmo).luminosity_distance(z) * 1e5
             model.set(**{self.amp_or_x0: model.get(self.amp_or_x0)*d_l**-2})
         else:
-            model.set_source_peakabsmag(*self.mag_max, cosmo=self.cosmo)
+            # Same as model.set_source_peakabsmag but using the distance table
+            mag, band, magsys = self.mag_max
+            model._source.set_peakmag(
+                mag + get_cosmology_table(self.cosmo).distmod(z), band, magsys
+            )
 
         return model
 
             
+class MultiBandRateCalculator(object):
+    """Rate calculators for several bands that share the evaluation of the
+    model: the magnitude-redshift tables of all bands are computed in one
+    pass (see get_mag_z_grid), in which the redshifted SED is evaluated
+    once per (z, phase) node and integrated through all bandpasses
+    together. Tables found in the cache are not recomputed.
+
+    The calculators of the individual bands are in calcs; all further
+    keyword arguments are passed on to them.
+    """
+    def __init__(self, model, bands, magsys='ab',
+                 t_above=None, t_before=None, mag_max=None,
+                 cosmo=_cosmo, logz_start=-3.5, logz_step=0.05,
+                 cache=None, **kwargs):
+        """
+        """
+        load_filters()
+
+        self.bands = list(bands)
+        self.magsys = ([magsys] * len(self.bands)
+                       if isinstance(magsys, basestring) else list(magsys))
+        mag_max = _get_mag_max_(mag_max)
+
+        tables = {}
+        keys = {}
+        for b, ms in zip(self.bands, self.magsys):
+            if cache is not None:
+                keys[b, ms] = get_table_key(cache, model, b, ms, t_above,
+                                            t_before, mag_max, logz_start,
+                                            logz_step, cosmo)
+                table = cache.get(keys[b, ms])
+                if table is not None:
+                    tables[b, ms] = (table['z'], table['m'])
+
+        missing = [(b, ms) for b, ms in zip(self.bands, self.magsys)
+                   if (b, ms) not in tables]
+        if len(missing) > 0:
+            z_max = np.array([get_z_max(model, b) for b, ms in missing])
+            z = get_z_grid(z_max.max(), logz_start, logz_step)
+            m = get_mag_z_grid(model, [b for b, ms in missing], z,
+                               magsys=[ms for b, ms in missing],
+                               t_above=t_above, t_before=t_before,
+                               mag_max=mag_max, cosmo=cosmo)
+            for k, b_ms in enumerate(missing):
+                mask = z < z_max[k]
+                tables[b_ms] = (z[mask], m[k][mask])
+                if cache is not None:
+                    cache.set(keys[b_ms], z=z[mask], m=m[k][mask])
+
+        self.calcs = [RateCalculator(model, band=b, magsys=ms,
+                                     t_above=t_above, t_before=t_before,
+                                     mag_max=mag_max, cosmo=cosmo,
+                                     logz_start=logz_start,
+                                     logz_step=logz_step, cache=cache,
+                                     mz_table=tables[b, ms], **kwargs)
+                      for b, ms in zip(self.bands, self.magsys)]
+
+    def get_mag_tables(self):
+        """Magnitude-redshift tables (z, m) of all bands up to their mag_lim
+        """
+        return [(c._z_interp, c._m_interp) for c in self.calcs]
+
+    def get_n_expected(self, mag, **kwargs):
+        """Expected numbers for each band (see RateCalculator.get_n_expected)
+        """
+        return [c.get_n_expected(mag, **kwargs) for c in self.calcs]
+
+    def get_z_dist(self, mag, **kwargs):
+        """Redshift distributions for each band (see
+        RateCalculator.get_z_dist)
+        """
+        return [c.get_z_dist(mag, **kwargs) for c in self.calcs]
+
+def _get_mag_max_(mag_max):
+    """Normalize mag_max to None or (mag, band, magsys)
+    """
+    if mag_max is not None and type(mag_max) is not tuple:
+        return (mag_max, 'bessellb', 'vega')
+    else:
+        return mag_max
+
+def get_z_max(model, band):
+    """Redshift beyond which the band is no longer covered by the model
+    """
+    b = sncosmo.get_bandpass(band)
+    return b.wave[0] / model.minwave() - 1
+
+def get_z_grid(z_max, logz_start=-3.5, logz_step=0.05):
+    """Full logarithmic redshift grid up to (excluding) z_max
+    """
+    n = int(np.floor((np.log10(z_max) - logz_start) / logz_step)) + 1
+    z = 10**(logz_start + logz_step * np.arange(max(n, 1)))
+
+    return z[z < z_max]
+
+def get_table_key(cache, model, band, magsys, t_above, t_before, mag_max,
+                  logz_start, logz_step, cosmo):
+    """Cache key of a magnitude-redshift table (incl. the data of the
+    bandpasses, see get_bandpass_id)
+    """
+    if mag_max is not None:
+        mag_max = (mag_max[0], get_bandpass_id(mag_max[1], mag_max[2]))
+
+    return cache.get_key(get_model_id(model), get_bandpass_id(band, magsys),
+                         t_above, t_before, mag_max, logz_start, logz_step,
+                         get_cosmo_key(cosmo))
+
+def get_mag_z_grid(model, band, z, magsys='ab', t_above=None, t_before=None,
+                   mag_max=None, cosmo=_cosmo):
+    """Magnitudes (peak, t_before before peak or for time above t_above)
+    for an array of redshifts in one band or a list of bands. The model is
+    scaled to 10 pc once (to mag_max if given) and band fluxes for all
+    redshifts and phases are computed together by bandflux_grid. The
+    distance modulus is added at the end.
+
+    returns array of shape (len(z),) or (n_band, len(z)); NaN where a band
+    is not covered by the model
+    """
+    multi = not isinstance(band, basestring)
+    bands = list(band) if multi else [band]
+    magsys = ([magsys] * len(bands) if isinstance(magsys, basestring)
+              else list(magsys))
+
+    z = np.atleast_1d(z)
+    model = copy.copy(model)
+    if mag_max is not None:
+        model._source.set_peakmag(*mag_max)
+
+    if t_above is not None:
+        phase, mags = lightcurve_grid(model, bands, z, magsys=magsys)
+        m = np.array([mag_t_above_grid(phase, mags_, t_above)[:, 0]
+                      for mags_ in mags])
+    else:
+        p_peak, m_peak = find_peak_grid(model, bands, z, magsys=magsys)
+        if t_before is None:
+            m = m_peak
+        else:
+            m = np.array([mag_grid(model, b, z, (p - t_before) / (1 + z),
+                                   magsys=ms)
+                          for b, ms, p in zip(bands, magsys, p_peak)])
+
+    m = m + get_cosmology_table(cosmo).distmod(z)
+
+    return m if multi else m[0]
+
 ############################
 #                          #
 # Lightcurve utilities     #
@@ -245,21 +576,353 @@ def cdf_gauss(x, mu, sig):
     """
     return (1 + erf((x - mu)/(np.sqrt(2) * sig))) / 2
         
+def get_n_direct(mags, sh_rate, z_binedges, f_mag_z, f_z_mag, mag_disp=None,
+                 sigma_cut=3.):
+    """Expected numbers for an array of limiting magnitudes from the shell
+    rates in bins z_binedges (see RateCalculator._get_n_direct_)
+    """
+    z_max = f_z_mag(mags + (sigma_cut*mag_disp if mag_disp is not None else 0))
+    z0, z1 = z_binedges[:-1], z_binedges[1:]
+    weights = np.clip((z_max[:, None] - z0[None, :]) / (z1 - z0)[None, :],
+                      0., 1.)
+    if mag_disp is not None:
+        weights *= cdf_gauss(mags[:, None], f_mag_z(0.5 * (z0 + z1))[None, :],
+                             mag_disp)
+
+    return np.dot(weights, sh_rate)
+
+def _observer_flux_(model, z, phase, wave):
+    """Observer-frame flux of the model at redshift z for rest-frame phases
+    and observer-frame wavelengths, including the model's effects
+    (cf. sncosmo.Model._flux)
+    """
+    a = 1. / (1. + z)
+    restwave = wave * a
+    f = model._source._flux(phase, restwave)
+
+    # The dust effects only scale the flux at each wavelength, so their
+    # transmissions are combined on a single row and applied once in place
+    trans = np.empty((1, len(wave)))
+    trans.fill(a)
+    for effect, frame, zindex in zip(model._effects, model._effect_frames,
+                                     model._effect_zindicies):
+        wave_ = wave / _get_effect_1pz_(model, frame, zindex, z)
+        if isinstance(effect, _DUST_EFFECTS):
+            trans = effect.propagate(wave_, trans)
+        else:
+            f *= trans
+            trans.fill(1.)
+            f = effect.propagate(wave_, f)
+    f *= trans
+
+    return f
+
+def _get_effect_1pz_(model, frame, zindex, z):
+    """1 + redshift of the frame of an effect ('obs', 'rest' at z or 'free'
+    at the redshift parameter of the effect, cf. sncosmo.Model._flux)
+    """
+    if frame == 'obs':
+        return 1.
+    elif frame == 'rest':
+        return 1. + z
+    elif frame == 'free':
+        return 1. + model._parameters[zindex]
+
+    raise ValueError('Unsupported frame of effect: %r'%(frame,))
+
+def _bandpass_weights_(bands, magsys, zp=30.):
+    """Common observer-frame wavelength grid (union of the sncosmo
+    integration grids of all bands) and integration weights (incl. the zero
+    points) of shape (n_wave, n_band) such that the band fluxes are
+    np.dot(flux, weights).
+
+    The kernels are kept in a process-wide LRU cache (at most _max_kernels)
+    keyed by the bandpass and magnitude system instances, so re-registered
+    bandpasses get new kernels. As the integration is done in the observer
+    frame on the grid of the bandpass, the kernels do not depend on the
+    redshift or the wavelength grid of the source.
+    """
+    bps = tuple(sncosmo.get_bandpass(band) for band in bands)
+    mss = tuple(sncosmo.get_magsystem(ms) for ms in magsys)
+    key = (bps, mss, zp)
+
+    with _kernels_lock:
+        kernel = _kernels.pop(key, None)
+        if kernel is None:
+            kernel = _build_bandpass_weights_(bps, mss, zp)
+            while len(_kernels) >= _max_kernels:
+                _kernels.popitem(last=False)
+        _kernels[key] = kernel
+
+    return kernel
+
+def _build_bandpass_weights_(bps, mss, zp):
+    """
+    """
+    grids = []
+    for b, ms in zip(bps, mss):
+        wave, dwave = integration_grid(b.minwave(), b.maxwave(),
+                                       MODEL_BANDFLUX_SPACING)
+        zpnorm = 10.**(0.4 * zp) / ms.zpbandflux(b)
+        grids.append((wave, wave * b(wave) * dwave / HC_ERG_AA * zpnorm))
+
+    wave, idx = np.unique(np.concatenate([g[0] for g in grids]),
+                          return_inverse=True)
+    weights = np.zeros((len(wave), len(bps)))
+    n = 0
+    for k, (wave_, weights_) in enumerate(grids):
+        weights[idx[n:n+len(wave_)], k] = weights_
+        n += len(wave_)
+
+    weights.flags.writeable = False
+
+    return wave, weights
+
+def bandflux(model, band, time, magsys='ab', zp=30.):
+    """Same as model.bandflux(band, time, zp, magsys) for a single band
+    but using the cached integration kernel (see _bandpass_weights_)
+    """
+    time = np.asarray(time, dtype=float)
+    z = model.get('z')
+    check_bands(model, [band])
+
+    wave, weights = _bandpass_weights_([band], [magsys], zp)
+    phase = (np.atleast_1d(time) - model.get('t0')) / (1 + z)
+    f = np.dot(_observer_flux_(model, z, phase, wave), weights[:, 0])
+
+    return f if time.ndim > 0 else f[0]
+
+def bandmag(model, band, magsys, time):
+    """Same as model.bandmag(band, magsys, time) but using the cached
+    integration kernel (see bandflux)
+    """
+    f = bandflux(model, band, time, magsys=magsys)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(f > 0, -2.5 * np.log10(f) + 30, np.nan)[()]
+
+def check_bands(model, bands):
+    """Raise ValueError (as sncosmo does) if one of the bands is not covered
+    by the model at its current redshift
+    """
+    valid = _get_band_valid_(model, bands, np.array([model.get('z')]))
+    for band, v in zip(bands, valid[:, 0]):
+        if not v:
+            b = sncosmo.get_bandpass(band)
+            raise ValueError('bandpass %r [%.6g, .., %.6g] outside spectral '
+                             'range [%.6g, .., %.6g]'
+                             %(b.name, b.minwave(), b.maxwave(),
+                               model.minwave(), model.maxwave()))
+
+def _get_band_valid_(model, bands, z):
+    """Mask of shape (n_band, len(z)) where the bands are fully covered by
+    the source and the effects of the model
+    """
+    rest_range = [model._source.minwave(), model._source.maxwave()]
+    obs_range = [0., np.inf]
+    for effect, frame, zindex in zip(model._effects, model._effect_frames,
+                                     model._effect_zindicies):
+        if frame == 'rest':
+            range_, f = rest_range, 1.
+        else:
+            # The redshift of 'free' frames does not depend on z
+            range_, f = obs_range, _get_effect_1pz_(model, frame, zindex, 0.)
+        range_[0] = max(range_[0], f * effect.minwave())
+        range_[1] = min(range_[1], f * effect.maxwave())
+
+    valid = []
+    for band in bands:
+        b = sncosmo.get_bandpass(band)
+        valid.append((b.minwave() / (1 + z) >= rest_range[0])
+                     & (b.maxwave() / (1 + z) <= rest_range[1])
+                     & (b.minwave() >= obs_range[0])
+                     & (b.maxwave() <= obs_range[1]))
+
+    return np.array(valid)
+
+def bandflux_grid(model, band, z, phase, magsys='ab', zp=30.):
+    """Band fluxes of the model for an array of redshifts and rest-frame
+    phases (w.r.t. t0). The amplitude is taken as set in the model, i.e.
+    no distance scaling is applied.
+
+    band may be a list of bands (with magsys a list as well); the SED is
+    then evaluated once per redshift on the union of the wavelength grids
+    of all bands covered by the model at that redshift.
+
+    phase may be 1d (same phases for all redshifts) or have shape
+    (len(z), n_phase).
+
+    returns array of shape (len(z), n_phase) or (n_band, len(z), n_phase);
+    NaN where a band is not covered by the model
+    """
+    multi = not isinstance(band, basestring)
+    bands = list(band) if multi else [band]
+    magsys = ([magsys] * len(bands) if isinstance(magsys, basestring)
+              else list(magsys))
+
+    z = np.atleast_1d(z)
+    phase = np.atleast_1d(phase)
+    if phase.ndim == 1:
+        phase = np.tile(phase, (len(z), 1))
+
+    wave, weights = _bandpass_weights_(bands, magsys, zp)
+    valid = _get_band_valid_(model, bands, z)
+    kernels = {}
+
+    f = np.empty((len(bands),) + phase.shape)
+    f.fill(np.nan)
+    for k, z_ in enumerate(z):
+        v = valid[:, k]
+        if not np.any(v):
+            continue
+        key = v.tostring()
+        if key not in kernels:
+            r = np.any(weights[:, v] != 0, axis=1)
+            kernels[key] = wave[r], weights[r][:, v]
+        wave_, weights_ = kernels[key]
+
+        f[v, k] = np.dot(_observer_flux_(model, z_, phase[k], wave_),
+                         weights_).T
+
+    return f if multi else f[0]
+
+def mag_grid(model, band, z, phase, magsys='ab'):
+    """Magnitudes at the given rest-frame phase (one per redshift)
+    """
+    f = bandflux_grid(model, band, z, np.atleast_1d(phase)[:, None],
+                      magsys=magsys)[:, 0]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return -2.5 * np.log10(f) + 30
+
+def find_peak_grid(model, band, z, amplitude=None, magsys='ab', sampling=1.,
+                   tol=1e-2, maxiter=50):
+    """Find peak phase and mag of the model for arrays of redshifts and
+    (optionally) amplitudes.
+
+    The band fluxes are evaluated on a common rest-frame phase grid (with
+    spacing sampling, plus the native phases of the source if available).
+    The bracket around the highest point is then refined for all redshifts
+    together by successive parabolic interpolation, falling back to golden
+    section steps, until it is narrower than tol (rest-frame days), i.e.
+    the peak phase is accurate to tol and the peak magnitude to second order
+    in tol (typically < 1e-4 mag). Peaks at the edges of the phase range are
+    not refined.
+
+    band may be a list of bands (with magsys a list as well), in which case
+    the coarse grid is computed for all of them at once.
+
+    amplitude: amplitude/x0 for each redshift (or scalar); by default the
+               amplitude set in the model is used
+
+    returns (phase, mag) arrays of shape (len(z),) or (n_band, len(z));
+    phases are in the observer frame w.r.t. t0
+    """
+    multi = not isinstance(band, basestring)
+    bands = list(band) if multi else [band]
+    magsys = ([magsys] * len(bands) if isinstance(magsys, basestring)
+              else list(magsys))
+
+    z = np.atleast_1d(z)
+    if amplitude is not None:
+        model = copy.copy(model)
+        model.set(**{('amplitude' if 'amplitude' in model.param_names
+                      else 'x0'): 1.})
+
+    p_min, p_max = model._source.minphase(), model._source.maxphase()
+    n_guess = int(np.ceil((p_max - p_min) / sampling)) + 1
+    p_guess = np.linspace(p_min, p_max, n_guess)
+    if hasattr(model._source, '_phase'):
+        p_guess = np.union1d(p_guess, model._source._phase)
+
+    f_guess = bandflux_grid(model, bands, z, p_guess, magsys=magsys)
+
+    p_peak, f_peak = np.array([
+        _refine_peak_(model, b, z, ms, p_guess, f_, tol, maxiter)
+        for b, ms, f_ in zip(bands, magsys, f_guess)
+    ]).transpose(1, 0, 2)
+
+    if amplitude is not None:
+        f_peak = f_peak * amplitude
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        m_peak = -2.5 * np.log10(f_peak) + 30
+
+    if multi:
+        return p_peak * (1 + z), m_peak
+    return p_peak[0] * (1 + z), m_peak[0]
+
+def _refine_peak_(model, band, z, magsys, p_guess, f_guess, tol, maxiter):
+    """Refine the maxima of the band fluxes f_guess (shape (len(z),
+    len(p_guess))) as described in find_peak_grid
+
+    returns rest-frame peak phases and fluxes
+    """
+    f_guess = np.where(np.isnan(f_guess), -np.inf, f_guess)
+
+    idx = np.arange(len(z))
+    k = np.argmax(f_guess, axis=1)
+    p_peak = p_guess[k]
+    f_peak = f_guess[idx, k]
+
+    # Bracket (a, b, c) with f(b) >= f(a), f(c)
+    active = (k > 0) & (k < len(p_guess) - 1) & np.isfinite(f_peak)
+    k = np.clip(k, 1, len(p_guess) - 2)
+    a, c = p_guess[k-1], p_guess[k+1]
+    f_a, f_c = f_guess[idx, k-1], f_guess[idx, k+1]
+
+    n_iter = 0
+    while np.any(active) and n_iter < maxiter:
+        i = np.where(active)[0]
+        a_, b_, c_ = a[i], p_peak[i], c[i]
+        fa_, fb_, fc_ = f_a[i], f_peak[i], f_c[i]
+
+        # Vertex of the parabola through the three points
+        with np.errstate(divide='ignore', invalid='ignore'):
+            num = (b_ - a_)**2 * (fb_ - fc_) - (b_ - c_)**2 * (fb_ - fa_)
+            den = (b_ - a_) * (fb_ - fc_) - (b_ - c_) * (fb_ - fa_)
+            u = b_ - 0.5 * num / den
+
+        golden = ~(np.isfinite(u) & (u > a_) & (u < c_)
+                   & (np.abs(u - b_) > tol / 4.))
+        right = (c_ - b_) > (b_ - a_)
+        u[golden & right] = (b_ + 0.381966 * (c_ - b_))[golden & right]
+        u[golden & ~right] = (b_ - 0.381966 * (b_ - a_))[golden & ~right]
+
+        f_u = bandflux_grid(model, band, z[i], u[:, None], magsys=magsys)[:, 0]
+        f_u[np.isnan(f_u)] = -np.inf
+
+        better = f_u >= fb_
+        # New peak: the old one becomes a bracket boundary
+        m = better & (u > b_)
+        a_[m], fa_[m] = b_[m], fb_[m]
+        m = better & (u <= b_)
+        c_[m], fc_[m] = b_[m], fb_[m]
+        b_[better], fb_[better] = u[better], f_u[better]
+        # Otherwise u becomes a bracket boundary
+        m = ~better & (u > b_)
+        c_[m], fc_[m] = u[m], f_u[m]
+        m = ~better & (u <= b_)
+        a_[m], fa_[m] = u[m], f_u[m]
+
+        a[i], p_peak[i], c[i] = a_, b_, c_
+        f_a[i], f_peak[i], f_c[i] = fa_, fb_, fc_
+        active[i] = (c_ - a_) > tol
+        n_iter += 1
+
+    return p_peak, np.where(np.isfinite(f_peak), f_peak, np.nan)
+
 def find_peak_phase_mag(model, band, magsys='ab', p_init=None, sampling=1.):
     """Find peak phase and mag for transient for specific band
-    and redshift
+    and redshift (see find_peak_grid unless p_init is given)
     
     returns (phase, mag)
     """ 
-    
     if p_init is None:
-        n_guess = int(np.ceil((model.maxtime()-model.mintime()) / sampling)) + 1
-        p_guess = np.linspace(model.mintime(), model.maxtime(), n_guess)
-        f_guess = -model.bandflux(band, p_guess, 30, magsys)
-        p_init = p_guess[np.where(f_guess == f_guess[~np.isnan(f_guess)].min())[0]]
+        p_peak, m_peak = find_peak_grid(model, band, model.get('z'),
+                                        magsys=magsys, sampling=sampling)
+        return p_peak[0] + model.get('t0'), m_peak[0]
     
     def _fct_min(p):
-        return -model.bandflux(band, p[0], 30, magsys)
+        return -bandflux(model, band, p[0], magsys=magsys)
          
     res = minimize(_fct_min, [p_init], bounds=[(model.mintime(), model.maxtime())])
         
@@ -275,7 +938,7 @@ def t_above_lim(model, band, limit, magsys='ab', p_peak=None, m_peak=None,
         return 0
     
     def _fct_new(p):
-        return model.bandmag(band, magsys, p) - limit
+        return bandmag(model, band, magsys, p) - limit
     
     if _fct_new(model.mintime()) < 0:
         p_0 = model.mintime()
@@ -289,19 +952,128 @@ def t_above_lim(model, band, limit, magsys='ab', p_peak=None, m_peak=None,
         
     return p_0, p_1
 
-def find_mag_t_above(model, band, t, magsys='ab', p_peak=None, m_peak=None,
-                     **kwargs):
-    if p_peak is None and m_peak is None:
-        p_peak, m_peak = find_peak_phase_mag(model, band, magsys, **kwargs)
-    
-    if t == 0.:
-        return m_peak
-    
-    def _fct_new(p):
-        return t_above_lim(model, band, p, magsys, p_peak=p_peak,
-                           m_peak=m_peak, **kwargs) - t
-    
-    return newton(_fct_new, m_peak)
+def find_mag_t_above(model, band, t, magsys='ab', **kwargs):
+    """Magnitude limit above which the model stays for time t (observer
+    frame, days) at its current redshift (see mag_t_above_grid)
+    """
+    phase, mags = lightcurve_grid(model, band, model.get('z'), magsys=magsys,
+                                  **kwargs)
+
+    return mag_t_above_grid(phase, mags, t)[0, 0]
+
+def lightcurve_grid(model, band, z, magsys='ab', sampling=0.25):
+    """Dense light curves of the model for an array of redshifts. The
+    rest-frame phase grid has spacing sampling (plus the native phases of the
+    source if available and the peak phase at each redshift).
+
+    band may be a list of bands (with magsys a list as well); the phase grid
+    then contains the peaks in all bands.
+
+    returns (phase, mags); phase has shape (len(z), n_phase) and is in the
+    observer frame w.r.t. t0, mags has shape (len(z), n_phase) or
+    (n_band, len(z), n_phase)
+    """
+    multi = not isinstance(band, basestring)
+    bands = list(band) if multi else [band]
+
+    z = np.atleast_1d(z)
+    p_min, p_max = model._source.minphase(), model._source.maxphase()
+    phase = np.linspace(p_min, p_max,
+                        int(np.ceil((p_max - p_min) / sampling)) + 1)
+    if hasattr(model._source, '_phase'):
+        phase = np.union1d(phase, model._source._phase)
+
+    p_peak = np.atleast_2d(find_peak_grid(model, bands, z, magsys=magsys)[0])
+    p_peak = np.where(np.isnan(p_peak), p_min * (1 + z), p_peak) / (1 + z)
+    phase = np.sort(np.hstack((np.tile(phase, (len(z), 1)), p_peak.T)),
+                    axis=1)
+
+    f = bandflux_grid(model, bands, z, phase, magsys=magsys)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mags = -2.5 * np.log10(f) + 30
+
+    return phase * (1 + z[:, None]), (mags if multi else mags[0])
+
+def t_above_lim_grid(phase, mags, limits):
+    """Time during which light curves are brighter than the limits. The
+    light curves are taken to be linear between the samples, so the result
+    is exact for them and multiple peaks are handled as well.
+
+    Each segment contributes its full duration for limits fainter than both
+    ends and a linear ramp in between. These contributions are accumulated
+    over the sorted segment ends, so the cost is O((n_phase + n_lim) log)
+    per light curve.
+
+    phase:   array of shape (n_phase,) or (n_lc, n_phase)
+    mags:    array of shape (n_lc, n_phase); NaN counts as not detected
+    limits:  array of shape (n_lim,) or (n_lc, n_lim)
+
+    returns array of shape (n_lc, n_lim)
+    """
+    mags = np.atleast_2d(mags)
+    phase = np.atleast_2d(phase)
+    limits = np.atleast_1d(limits)
+    limits = np.tile(limits, (len(mags), 1)) if limits.ndim == 1 else limits
+
+    out = np.empty(limits.shape)
+    for k in range(len(mags)):
+        m = np.where(np.isnan(mags[k]), np.inf, mags[k])
+        dt = np.diff(phase[k % len(phase)])
+        lo = np.minimum(m[:-1], m[1:])
+        hi = np.maximum(m[:-1], m[1:])
+
+        # Segments that are flat or partially undetected only count in full
+        ramp = np.isfinite(hi) & (hi - lo > 1e-10)
+        slope = np.where(ramp, dt / np.where(ramp, hi - lo, 1.), 0.)
+
+        i_lo = np.argsort(lo)
+        i_hi = np.argsort(hi)
+        cum = lambda x, i: np.append(0., np.cumsum(x[i]))
+        n_lo = np.searchsorted(lo[i_lo], limits[k], side='left')
+        n_hi = np.searchsorted(hi[i_hi], limits[k], side='right')
+
+        full = cum(np.where(ramp, dt, 0.), i_hi)[n_hi]
+        full += cum(np.where(ramp | np.isinf(hi), 0., dt), i_lo)[n_lo]
+        s1 = cum(slope, i_lo)[n_lo] - cum(slope, i_hi)[n_hi]
+        s2 = cum(slope * lo, i_lo)[n_lo] - cum(slope * lo, i_hi)[n_hi]
+
+        out[k] = full + limits[k] * s1 - s2
+
+    return out
+
+def mag_t_above_grid(phase, mags, t):
+    """Magnitude limits for which light curves are brighter than the limit
+    for time t, i.e. the inverse of t_above_lim_grid. The time above the
+    limit is evaluated with the sampled magnitudes (sorted) as limits; as
+    it is linear in between, interpolation gives the exact inverse.
+    t = 0 returns the peak magnitude and t = the time above the faintest
+    sample (the full duration if all are detected) that magnitude; longer t
+    NaN.
+
+    t:       array of shape (n_t,) or (n_lc, n_t)
+
+    returns array of shape (n_lc, n_t)
+    """
+    mags = np.atleast_2d(mags)
+    phase = np.atleast_2d(phase)
+    t = np.atleast_1d(t)
+    t = np.tile(t, (len(mags), 1)) if t.ndim == 1 else t
+
+    out = np.empty(t.shape)
+    for k in range(len(mags)):
+        levels = np.sort(mags[k][~np.isnan(mags[k])])
+        if len(levels) == 0:
+            out[k] = np.nan
+            continue
+
+        t_levels = t_above_lim_grid(phase[k % len(phase)], mags[k:k+1],
+                                    levels)[0]
+        out[k] = np.interp(t[k], t_levels, levels, right=np.nan)
+        # The full time above may differ from t_levels[-1] by round-off
+        out[k][np.isclose(t[k], t_levels[-1], rtol=1e-10,
+                          atol=0.)] = levels[-1]
+
+    return out
 
 # def weighted_t_above_lim(model, z, band, limit, magsys='ab',
 #                              sig=1.0, deg_gh=11, **kwargs):
@@ -346,16 +1118,27 @@ def bisection(f, x0, x1, tol=1e-5, nmax=100):
     return False
 
 def shell_rate(zmin, zmax, ratefunc=(lambda z: 3e-7),
-               nbins=100, cosmo=_cosmo, time=365.25, area=1.):
+               nbins=100, cosmo=_cosmo, time=365.25, area=1.,
+               z_binedges=None):
     """
     rate in Mpc^-3 yr^-1
+
+    z_binedges: explicit bin edges (overrides zmin, zmax and nbins)
+
+    If ratefunc is a RateModel (see utils/ratemodels.py), the shell rates
+    are differences of its tabulated cumulative numbers.
     
     returns shell rate and bin centers
     """
     f = time / 365.25 * area
-    z_binedges = np.linspace(zmin, zmax, nbins + 1)
+    if z_binedges is None:
+        z_binedges = np.linspace(zmin, zmax, nbins + 1)
     z_binctrs = 0.5 * (z_binedges[1:] + z_binedges[:-1])
-    sphere_vols = cosmo.comoving_volume(z_binedges).value
+
+    if isinstance(ratefunc, RateModel):
+        return f * np.diff(ratefunc.get_n_cum(z_binedges, cosmo)), z_binctrs
+
+    sphere_vols = get_cosmology_table(cosmo).comoving_volume(z_binedges)
     shell_vols = sphere_vols[1:] - sphere_vols[:-1]
     
     return (f * shell_vols * ratefunc(z_binctrs) / (1.+z_binctrs),
@@ -0,0 +1,74 @@
+import hashlib
+import numpy as np
+
+from django.core.cache import caches
+from django.utils.http import quote_etag, parse_etags
+
+from ratecalc_django.settings import (RESPONSE_CACHE_ALIAS,
+                                      RESPONSE_CACHE_DIGITS)
+
+RESPONSE_CACHE_VERSION = 1
+
+def canonical(obj, digits=RESPONSE_CACHE_DIGITS):
+    """Canonical form of the calculator inputs for the cache key: numbers
+    as floats rounded to digits significant digits (-0. as 0.), dicts as
+    sorted tuples of items, lists as tuples and unicode as (utf-8) str
+    """
+    if isinstance(obj, (bool, np.bool_)) or obj is None:
+        return obj
+    elif isinstance(obj, unicode):
+        return obj.encode('utf-8')
+    elif isinstance(obj, (int, long, float, np.integer, np.floating)):
+        return float('%.*g'%(digits, obj)) + 0.
+    elif isinstance(obj, dict):
+        return tuple(sorted((canonical(k, digits), canonical(v, digits))
+                            for k, v in obj.items()))
+    elif isinstance(obj, (list, tuple, np.ndarray)):
+        return tuple(canonical(v, digits) for v in obj)
+    else:
+        return obj
+
+def get_response_key(kind, params):
+    """Cache key of the result of a calculator view (kind, e.g.
+    'lightcurve') for the parameters collected by get_calc
+    """
+    return 'ratecalc:%s:%s'%(kind, hashlib.md5(
+        repr((RESPONSE_CACHE_VERSION, canonical(params)))
+    ).hexdigest())
+
+def get_cached_response(key):
+    """
+    """
+    return caches[RESPONSE_CACHE_ALIAS].get(key)
+
+def set_cached_response(key, data):
+    """Store data under key (timeout and number of entries are set by the
+    configuration of the RESPONSE_CACHE_ALIAS cache)
+    """
+    caches[RESPONSE_CACHE_ALIAS].set(key, data)
+
+def get_etag(key, *variant):
+    """ETag (unquoted) of the response for the cache key and a variant of
+    the output (e.g. the format)
+    """
+    return hashlib.md5(repr((key,) + variant)).hexdigest()
+
+def set_etag(response, etag, weak=False):
+    """Set the ETag header; weak for responses that differ in details
+    that do not depend on the key (e.g. the CSRF token of a page)
+    """
+    response['ETag'] = ('W/' if weak else '') + quote_etag(etag)
+    return response
+
+def etag_matches(request, etag):
+    """Whether a conditional GET or HEAD request already has the response
+    with etag
+    """
+    if request.method not in ('GET', 'HEAD'):
+        return False
+
+    etags = [e[2:] if e.startswith('W/') else e for e in
+             parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))]
+    etags = [e.strip('"') for e in etags]
+
+    return etag in etags or '*' in etags
@@ -0,0 +1,168 @@
+import numpy as np
+import multiprocessing
+
+import sncosmo
+
+from scipy.interpolate import InterpolatedUnivariateSpline as Spline1d
+
+from rates import shell_rate
+
+CATALOG_DTYPE = [('z', float), ('mag', float), ('epoch', float),
+                 ('dmag', float), ('ebv', float)]
+
+class SurveySimulator(object):
+    """Monte Carlo version of RateCalculator.get_n_expected/get_z_dist.
+
+    The number of transients in the survey volume and time is drawn from a
+    Poisson distribution around the integral of shell_rate; redshifts are
+    drawn from the cumulative shell rates, epochs uniformly during the
+    survey. Magnitudes are taken from the magnitude-redshift spline of the
+    calculator plus a Gaussian dispersion (mag_disp of the calculator) and
+    optionally host extinction drawn from an exponential E(B-V)
+    distribution (in addition to any extinction set in the model).
+    Transients brighter than the limiting magnitude of the survey (which
+    does not depend on the state of the calculator) are detected.
+
+    Draws are made in chunks of chunk_size with seeds derived from the main
+    seed, so results do not depend on the number of processes.
+    """
+    def __init__(self, calc, mag_lim, host_ebv=None, host_r_v=2.,
+                 n_z=4096):
+        """
+        calc:     RateCalculator (band, area, time, rate, cosmology,
+                  dispersion and m(z) table are taken from it)
+        mag_lim:  limiting magnitude of the survey
+        host_ebv: scale of the exponential E(B-V) distribution of the host
+                  extinction (None for no extinction)
+        host_r_v: R_V of the host extinction (CCM89)
+        n_z:      number of redshift bins of the cumulative rate table
+        """
+        self.calc = calc
+        self.mag_lim = mag_lim
+        self.host_ebv = host_ebv
+        self.host_r_v = host_r_v
+
+        # Transients beyond the redshift of mag_lim (plus the dispersion
+        # cut) cannot be detected (same cut as in the analytic calculation);
+        # the m(z) table of calc is extended to it if needed
+        calc._check_mag_lim_(mag_lim)
+        z_max = float(calc.f_z_mag(mag_lim + (calc.sigma_cut * calc.mag_disp
+                                              if calc.mag_disp is not None
+                                              else 0.)))
+        self._z_binedges = np.linspace(0., z_max, n_z + 1)
+        sh_rate, z = shell_rate(0., z_max, calc.ratefunc, cosmo=calc.cosmo,
+                                time=calc.time, area=calc.area/100.,
+                                z_binedges=self._z_binedges)
+        self._n_cum = np.append(0., np.cumsum(sh_rate))
+
+        self._a_host = None
+        if host_ebv is not None:
+            self._a_host = self._get_host_extinction_(calc._z_interp)
+
+    @property
+    def n_expected(self):
+        """Expected number of transients in the survey volume and time
+        """
+        return self._n_cum[-1]
+
+    def _get_host_extinction_(self, z):
+        """Extinction in the band for E(B-V) = 1 at rest-frame wavelength
+        wave_eff / (1 + z)
+        """
+        dust = sncosmo.CCM89Dust()
+        dust.set(ebv=1., r_v=self.host_r_v)
+        wave = sncosmo.get_bandpass(self.calc.band).wave_eff / (1 + z)
+
+        return -2.5 * np.log10(dust.propagate(wave, np.ones(len(z))))
+
+    def _get_chunk_args_(self, seed, n, chunk_size):
+        """
+        """
+        rs = np.random.RandomState(seed)
+        n_total = rs.poisson(self.n_expected) if n is None else n
+        n_chunks = int(np.ceil(n_total / float(chunk_size)))
+        seeds = rs.randint(2**31 - 1, size=n_chunks)
+
+        tables = {'z_binedges': self._z_binedges, 'n_cum': self._n_cum,
+                  'z_interp': self.calc._z_interp,
+                  'm_interp': self.calc._m_interp,
+                  'a_host': self._a_host,
+                  'time': self.calc.time,
+                  'mag_disp': self.calc.mag_disp,
+                  'host_ebv': self.host_ebv,
+                  'mag_lim': self.mag_lim}
+
+        return n_total, [(s, min(chunk_size, n_total - k * chunk_size), tables)
+                         for k, s in enumerate(seeds)]
+
+    def simulate(self, seed=None, n=None, chunk_size=1000000, processes=1,
+                 detected_only=True):
+        """Simulate one survey.
+
+        seed:          seed of the random numbers
+        n:             number of transients to draw (default: Poisson
+                       distributed around n_expected)
+        processes:     number of worker processes (None for all CPUs)
+        detected_only: only return detected transients in the catalog
+
+        returns catalog (structured array with fields z, mag, epoch, dmag
+        and ebv) and dict of summary counts
+        """
+        n_total, chunk_args = self._get_chunk_args_(seed, n, chunk_size)
+
+        if processes == 1 or len(chunk_args) <= 1:
+            results = map(_simulate_chunk_, chunk_args)
+        else:
+            pool = multiprocessing.Pool(processes)
+            try:
+                results = pool.map(_simulate_chunk_, chunk_args)
+            finally:
+                pool.close()
+                pool.join()
+
+        if len(results) > 0:
+            catalog = np.concatenate(results)
+        else:
+            catalog = np.zeros(0, dtype=CATALOG_DTYPE)
+
+        detected = catalog['mag'] <= self.mag_lim
+        summary = {'n_expected': self.n_expected,
+                   'n_total': n_total,
+                   'n_detected': int(detected.sum())}
+
+        if detected_only:
+            catalog = catalog[detected]
+
+        return catalog, summary
+
+    def simulate_counts(self, n_surveys, seed=None, **kwargs):
+        """Numbers of detected transients in n_surveys independent surveys
+        (see simulate)
+        """
+        seeds = np.random.RandomState(seed).randint(2**31 - 1, size=n_surveys)
+
+        return np.array([self.simulate(seed=s, **kwargs)[1]['n_detected']
+                         for s in seeds])
+
+def _simulate_chunk_(args):
+    """Draw n transients with seed from the tables (see
+    SurveySimulator._get_chunk_args_)
+    """
+    seed, n, tables = args
+    rs = np.random.RandomState(seed)
+
+    catalog = np.zeros(n, dtype=CATALOG_DTYPE)
+    catalog['z'] = np.interp(rs.uniform(0., tables['n_cum'][-1], n),
+                             tables['n_cum'], tables['z_binedges'])
+    catalog['epoch'] = rs.uniform(0., tables['time'], n)
+
+    mag = Spline1d(tables['z_interp'], tables['m_interp'])(catalog['z'])
+    if tables['mag_disp'] is not None:
+        catalog['dmag'] = rs.normal(0., tables['mag_disp'], n)
+    if tables['host_ebv'] is not None:
+        catalog['ebv'] = rs.exponential(tables['host_ebv'], n)
+        mag += catalog['ebv'] * np.interp(catalog['z'], tables['z_interp'],
+                                          tables['a_host'])
+    catalog['mag'] = mag + catalog['dmag']
+
+    return catalog
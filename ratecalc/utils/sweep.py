@@ -0,0 +1,111 @@
+import numpy as np
+
+from collections import OrderedDict as odict
+
+from rates import (MultiBandRateCalculator, shell_rate, get_n_direct, _cosmo)
+from ratemodels import ConstantRate
+
+SWEEP_DIMS = ('mag_lim', 'mag_disp', 'area', 'time', 'rate', 'band')
+
+class SweepResult(object):
+    """N-dimensional array of expected numbers with one labelled axis per
+    swept parameter (in the order of dims)
+    """
+    def __init__(self, values, coords):
+        """
+        values: array with one axis per entry of coords
+        coords: OrderedDict of parameter name -> values
+        """
+        self.values = values
+        self.coords = coords
+
+    @property
+    def dims(self):
+        return tuple(self.coords.keys())
+
+    def sel(self, **kwargs):
+        """Select by parameter values (nearest for floats), e.g.
+        sel(band='lsstr', mag_lim=24.); selected axes are removed
+        """
+        idx = []
+        coords = odict()
+        for name, values in self.coords.items():
+            if name in kwargs:
+                if values.dtype.kind in 'fi':
+                    idx.append(int(np.argmin(np.abs(values - kwargs[name]))))
+                else:
+                    idx.append(list(values).index(kwargs[name]))
+            else:
+                idx.append(slice(None))
+                coords[name] = values
+
+        return SweepResult(self.values[tuple(idx)], coords)
+
+    def squeeze(self):
+        """Remove axes of length 1
+        """
+        coords = odict((k, v) for k, v in self.coords.items() if len(v) > 1)
+        return SweepResult(self.values.reshape([len(v) for v in
+                                                coords.values()]),
+                           coords)
+
+def sweep_n_expected(model, mag_lim, mag_disp=None, area=100., time=365.25,
+                     rate=1., band='bessellux', magsys='ab', ratefunc=None,
+                     sigma_cut=3., cosmo=_cosmo, nbins=1000, **kwargs):
+    """Expected numbers of transients on a grid of survey parameters.
+
+    Each argument of SWEEP_DIMS may be a scalar or a list of values.
+    The magnitude-redshift tables of all bands are computed once (see
+    MultiBandRateCalculator; further keyword arguments are passed on to it)
+    and one grid of nbins shell rates up to the largest redshift needed is
+    shared by all limiting magnitudes and dispersions of a band. area, time
+    and rate only enter as factors of the result.
+
+    mag_disp: values of the peak magnitude dispersion (None or 0 for no
+              dispersion)
+    rate:     factors of ratefunc (default: constant rate of 1 Mpc^-3 yr^-1,
+              i.e. rate is the volumetric rate)
+
+    returns SweepResult with axes SWEEP_DIMS
+    """
+    if ratefunc is None:
+        ratefunc = ConstantRate(1.)
+
+    mag_disp = [d if d is not None else 0.
+                for d in np.atleast_1d(np.array(mag_disp, dtype=object))]
+
+    coords = odict()
+    for name, values in zip(SWEEP_DIMS, [mag_lim, mag_disp, area, time,
+                                         rate, band]):
+        coords[name] = np.atleast_1d(np.array(values, dtype=(
+            float if name != 'band' else object
+        )))
+
+    mags = coords['mag_lim']
+    disps = coords['mag_disp']
+    calcs = MultiBandRateCalculator(model, coords['band'], magsys=magsys,
+                                    mag_lim=mags.max(),
+                                    mag_disp=(disps.max() if disps.max() > 0
+                                              else None),
+                                    sigma_cut=sigma_cut, cosmo=cosmo,
+                                    ratefunc=ratefunc, **kwargs).calcs
+
+    # Expected numbers for a year and 100 sq. deg. as (mag_lim, mag_disp, band)
+    n = np.zeros((len(mags), len(disps), len(calcs)))
+    for k, calc in enumerate(calcs):
+        z_max = calc.f_z_mag(mags.max() + sigma_cut * disps.max())
+        z_binedges = np.linspace(0., z_max, nbins + 1)
+        sh_rate, z = shell_rate(0., z_max, ratefunc, cosmo=cosmo,
+                                z_binedges=z_binedges)
+        for l, disp in enumerate(disps):
+            n[:, l, k] = get_n_direct(mags, sh_rate, z_binedges,
+                                      calc.f_mag_z, calc.f_z_mag,
+                                      disp if disp > 0 else None, sigma_cut)
+
+    factors = (coords['area'][:, None, None] / 100.
+               * coords['time'][None, :, None] / 365.25
+               * coords['rate'][None, None, :])
+    values = (n[:, :, None, None, None, :]
+              * factors[None, None, :, :, :, None])
+
+    return SweepResult(values, coords)
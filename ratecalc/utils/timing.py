@@ -0,0 +1,91 @@
+import time
+import threading
+
+from collections import OrderedDict as odict
+
+_stats = {}
+_stats_lock = threading.Lock()
+
+class StageTimer(object):
+    """Wall time per stage of a request. A stage lasts from start(name)
+    until the next start or stop; repeated stages are summed.
+    """
+    def __init__(self):
+        """
+        """
+        self.stages = odict()
+        self._t_start = time.time()
+        self._t_stop = None
+        self._current = None
+        self._t_current = None
+
+    def start(self, name):
+        """End the current stage (if any) and start stage name
+        """
+        t = time.time()
+        self._end_current_(t)
+        self._current = name
+        self._t_current = t
+
+    def stop(self):
+        """End the current stage
+        """
+        self._end_current_(time.time())
+
+    def finish(self):
+        """End the current stage and the total time
+        """
+        self._t_stop = time.time()
+        self._end_current_(self._t_stop)
+
+    def _end_current_(self, t):
+        if self._current is not None:
+            self.stages[self._current] = (self.stages.get(self._current, 0.)
+                                          + t - self._t_current)
+            self._current = None
+
+    @property
+    def total(self):
+        return (self._t_stop if self._t_stop is not None
+                else time.time()) - self._t_start
+
+    def get_header(self):
+        """Value of the Server-Timing header (durations in ms)
+        """
+        return ', '.join(['%s;dur=%.1f'%(name, 1e3 * dt)
+                          for name, dt in self.stages.items()]
+                         + ['total;dur=%.1f'%(1e3 * self.total)])
+
+def get_timer(request):
+    """Timer of the request (set by TimingMiddleware) or an unused one
+    """
+    timer = getattr(request, 'timer', None)
+    return timer if timer is not None else StageTimer()
+
+def record_stats(view, timer):
+    """Add the stage times of a request to the process-wide statistics
+    """
+    with _stats_lock:
+        view_stats = _stats.setdefault(view, odict())
+        for name, dt in timer.stages.items() + [('total', timer.total)]:
+            s = view_stats.setdefault(name, {'count': 0, 'sum': 0., 'max': 0.})
+            s['count'] += 1
+            s['sum'] += dt
+            s['max'] = max(s['max'], dt)
+
+def get_stats():
+    """Number of requests and mean and maximal time (in ms) of each stage
+    per view
+    """
+    with _stats_lock:
+        return {view: odict((name, {'count': s['count'],
+                                    'mean': 1e3 * s['sum'] / s['count'],
+                                    'max': 1e3 * s['max']})
+                            for name, s in view_stats.items())
+                for view, view_stats in _stats.items()}
+
+def reset_stats():
+    """
+    """
+    with _stats_lock:
+        _stats.clear()
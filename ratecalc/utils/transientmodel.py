@@ -1,11 +1,15 @@
 import os
+import copy
+import threading
 import numpy as np
 import sncosmo
 from scipy.interpolate import RectBivariateSpline as Spline2d
-from scipy.optimize import newton
+from collections import OrderedDict as odict
 
 from rates import _cosmo
-from ratecalc_django.settings import BASE_DIR
+from cosmology import get_cosmology_table
+from cache import read_griddata_cached
+from ratecalc_django.settings import BASE_DIR, MODEL_REGISTRY_SIZE
 
 def _get_built_in_model_(sncosmo_name='salt2', amplitude=None, **kwargs):
     """
@@ -18,7 +22,10 @@ def _get_built_in_model_(sncosmo_name='salt2', amplitude=None, **kwargs):
     return model
 
 def _get_model_from_file_(model_file=None, **kwargs):
-    return load_sed_model(os.path.join(BASE_DIR, model_file))
+    return load_sed_model(os.path.join(BASE_DIR, model_file), use_cache=True)
+
+_models = odict()
+_models_lock = threading.Lock()
 
 _transient_loaders = {
     'built-in': _get_built_in_model_,
@@ -36,6 +43,39 @@ def get_transient_model(model_type='built-in', **kwargs):
     model.add_effect(sncosmo.CCM89Dust(), 'mw', 'obs')
         
     return model
+
+def get_model_file_stamp(model_type='built-in', **kwargs):
+    """Modification time and size of the file of models loaded from files
+    (empty tuple for other models)
+    """
+    if model_type != 'load-file':
+        return ()
+
+    stat = os.stat(os.path.join(BASE_DIR, kwargs['model_file']))
+    return (stat.st_mtime, stat.st_size)
+
+def get_cached_transient_model(model_type='built-in', **kwargs):
+    """Copy of a prototype model from a process-wide LRU registry (holding
+    at most MODEL_REGISTRY_SIZE models) or a new model from
+    get_transient_model. Models loaded from files are keyed by the
+    modification time and size of the file as well.
+    """
+    key = ((model_type, tuple(sorted(kwargs.items())))
+           + get_model_file_stamp(model_type, **kwargs))
+
+    with _models_lock:
+        model = _models.pop(key, None)
+        if model is not None:
+            _models[key] = model
+
+    if model is None:
+        model = get_transient_model(model_type=model_type, **kwargs)
+        with _models_lock:
+            _models[key] = model
+            while len(_models) > MODEL_REGISTRY_SIZE:
+                _models.popitem(last=False)
+
+    return copy.copy(model)
                           
 def scale_model(model, mag=None, band='bessellb', magsys='vega',
                 return_amplitude=False):
@@ -47,7 +87,7 @@ def scale_model(model, mag=None, band='bessellb', magsys='vega',
         dm = 0
         
     if z > 0:
-        d_l = _cosmo.luminosity_distance(z).value * 1e5
+        d_l = get_cosmology_table(_cosmo).luminosity_distance(z) * 1e5
     else:
         d_l = 1
         
@@ -60,11 +100,9 @@ def scale_model(model, mag=None, band='bessellb', magsys='vega',
 def get_z_from_dist(d_l):
     if d_l == 1e-5:
         return 0.
-    z_guess = d_l * _cosmo.H0.value / 3e5
-
-    f_newton = lambda z: _cosmo.luminosity_distance(z).value - d_l
 
-    return np.round(newton(f_newton, z_guess), 7)
+    return np.round(get_cosmology_table(_cosmo).z_at_luminosity_distance(d_l),
+                    7)
     
 class TimeSeriesSource(sncosmo.Source):
     """A single-component spectral time series model.
@@ -97,13 +135,31 @@ class TimeSeriesSource(sncosmo.Source):
         Name of the model. Default is `None`.
     version : str, optional
         Version of the model. Default is `None`.
+    flux_mode : {'spline', 'grid'}, optional
+        How the flux is evaluated. 'spline' (default) evaluates the 2d
+        spline (degrees kx, ky) on every call. 'grid' evaluates the spline
+        once on the native wavelength grid and a phase grid with n_sub
+        steps per native phase step and then interpolates linearly in phase
+        (on the native wavelengths within the requested range) and then in
+        wavelength. For calls with many phases this is ~1.5 times faster,
+        for single phases it is slower. Between the grid points the flux is
+        a linear instead of a quadratic interpolation: for smooth SEDs
+        sampled at 20-100 A the flux differs by ~1e-3 of its maximum and
+        magnitude-redshift tables by ~2e-4 mag for n_sub = 4 (~5e-3 mag for
+        n_sub = 1); narrow spectral features are affected more.
+    n_sub : int, optional
+        Phase subdivisions of the precomputed grid (flux_mode 'grid').
+    dtype : dtype, optional
+        Storage type of the precomputed grid, e.g. `numpy.float32` to halve
+        its memory at a relative precision of ~1e-7 (flux_mode 'grid').
     """
 
     _param_names = ['amplitude']
     param_names_latex = ['A']
 
     def __init__(self, phase, wave, flux, zero_before=False, name=None,
-                 version=None, kx=2, ky=2):
+                 version=None, kx=2, ky=2, flux_mode='spline', n_sub=4,
+                 dtype=np.float64):
         self.name = name
         self.version = version
         self._phase = phase
@@ -112,17 +168,115 @@ class TimeSeriesSource(sncosmo.Source):
         self._model_flux = Spline2d(phase, wave, flux, kx=kx, ky=ky)
         self._zero_before = zero_before
 
+        self._flux_mode = flux_mode
+        if flux_mode == 'grid':
+            self._init_grid_(n_sub, dtype)
+        elif flux_mode != 'spline':
+            raise ValueError('Unknown flux mode: %s'%flux_mode)
+
+    def _init_grid_(self, n_sub, dtype):
+        """Evaluate the spline on the native wavelengths and a phase grid
+        refined by n_sub
+        """
+        phase = np.append(
+            (self._phase[:-1, None] + np.diff(self._phase)[:, None]
+             * np.arange(n_sub)[None, :] / float(n_sub)).ravel(),
+            self._phase[-1]
+        )
+        self._grid_id = (n_sub, np.dtype(dtype).name)
+        self._grid_phase = phase
+        self._grid_flux = self._model_flux(phase, self._wave).astype(dtype)
+        self._grid_wave_weights = None
+        self._buffers = threading.local()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_buffers', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self._flux_mode == 'grid':
+            self._buffers = threading.local()
+
+    def _get_buffer_(self, name, shape):
+        """Per-thread scratch array of the grid dtype (reused between calls)
+        """
+        buf = getattr(self._buffers, name, None)
+        if buf is None or buf.shape != shape:
+            buf = np.empty(shape, dtype=self._grid_flux.dtype)
+            setattr(self._buffers, name, buf)
+
+        return buf
+
+    def _get_wave_weights_(self, wave):
+        """Indices (relative to the first native wavelength needed) and
+        weights of linear interpolation on the native wavelengths, and the
+        slice of native wavelengths needed (cached for the last wavelength
+        array)
+        """
+        cached = self._grid_wave_weights
+        if (cached is not None and cached[0].shape == wave.shape
+            and np.array_equal(cached[0], wave)):
+            return cached[1:]
+
+        idx, weights = _get_interp_weights_(self._wave, wave)
+        cols = slice(idx.min(), idx.max() + 2)
+        self._grid_wave_weights = (wave.copy(), idx - cols.start, weights,
+                                   cols)
+
+        return self._grid_wave_weights[1:]
+
+    def _grid_flux_(self, phase, wave):
+        """Linear interpolation of the precomputed grid, first in phase (on
+        the native wavelengths needed) and then in wavelength
+        """
+        phase = np.atleast_1d(np.asarray(phase, dtype=float))
+        wave = np.atleast_1d(np.asarray(wave, dtype=float))
+
+        i_p, u_p = _get_interp_weights_(self._grid_phase, phase)
+        i_w, u_w, cols = self._get_wave_weights_(wave)
+
+        grid = self._grid_flux[:, cols]
+        shape = (len(phase), grid.shape[1])
+        rows = self._get_buffer_('rows', shape)
+        tmp = self._get_buffer_('tmp', shape)
+
+        np.multiply(grid[i_p], (1 - u_p)[:, None], out=rows)
+        np.multiply(grid[i_p + 1], u_p[:, None], out=tmp)
+        rows += tmp
+
+        f = rows[:, i_w] * (1 - u_w)
+        f += rows[:, i_w + 1] * u_w
+
+        return f
+
     def _flux(self, phase, wave):
-        f = self._parameters[0] * self._model_flux(phase, wave)
+        if self._flux_mode == 'grid':
+            f = self._parameters[0] * self._grid_flux_(phase, wave)
+        else:
+            f = self._parameters[0] * self._model_flux(phase, wave)
         
         if self._zero_before:
             mask = np.atleast_1d(phase) < self.minphase()
             f[mask, :] = 0.
 
         return f
+
+def _get_interp_weights_(x, x_new):
+    """Lower indices and weights of linear interpolation on the grid x
+    (constant beyond its ends)
+    """
+    x_new = np.clip(x_new, x[0], x[-1])
+    idx = np.clip(np.searchsorted(x, x_new, side='right') - 1, 0, len(x) - 2)
+
+    return idx, (x_new - x[idx]) / (x[idx + 1] - x[idx])
     
-def load_sed_model(filename, p_min=5e-4, p_max=50, **kwargs):
+def load_sed_model(filename, p_min=5e-4, p_max=50, use_cache=False,
+                   **kwargs):
     """
+    use_cache: read the SED grid from the binary sidecar cache (see
+               read_griddata_cached in utils/cache.py)
     """
     # sed = np.genfromtxt(filename)
 
@@ -137,7 +291,10 @@ def load_sed_model(filename, p_min=5e-4, p_max=50, **kwargs):
     # # Multiply by 1e-8
     # flux = np.array([sed[sed[:,0] == p,2] for p in phase]) * 1e-8
 
-    phase, wave, flux = sncosmo.read_griddata_ascii(filename)
+    if use_cache:
+        phase, wave, flux = read_griddata_cached(filename)
+    else:
+        phase, wave, flux = sncosmo.read_griddata_ascii(filename)
 
     k0, k1 = 0, -1
     if p_min is not None:
@@ -1,9 +1,16 @@
 # import inspect
 import numpy as np
+import json
+import logging
 
 from django.shortcuts     import render
+from django.http          import (JsonResponse, StreamingHttpResponse,
+                                  HttpResponseBadRequest,
+                                  HttpResponseNotModified)
+from django.db            import DatabaseError
 from django.core.urlresolvers import resolve
 from django.utils.safestring import mark_safe
+from django.views.decorators.csrf import csrf_exempt
 
 from ratecalc.models      import TransientModel, TransientType, Category
 from ratecalc.forms       import TransientForm, _band_dict
@@ -11,9 +18,19 @@ from ratecalc.forms       import TransientForm, _band_dict
 from utils.lightcurve     import get_lightcurves
 from utils.plot           import plot_lightcurve, plot_expected, plot_redshift
 from utils.formatdata     import (format_lightcurve_data, format_expected_data,
-                                  format_redshift_data)
-from utils.rates          import RateCalculator
-from utils.transientmodel import get_transient_model, scale_model, get_z_from_dist
+                                  format_redshift_data, get_table, iter_csv,
+                                  iter_npy, iter_binary)
+from utils.rates          import RateCalculator, MultiBandRateCalculator
+from utils.transientmodel import (get_cached_transient_model, scale_model,
+                                  get_z_from_dist, get_model_file_stamp)
+from utils.cache          import get_table_cache, get_bandpass_id
+from utils.ratemodels     import get_rate_model
+from utils.timing         import get_timer, get_stats, reset_stats
+from utils.responsecache  import (get_response_key, get_cached_response,
+                                  set_cached_response, get_etag, set_etag,
+                                  etag_matches)
+
+logger = logging.getLogger(__name__)
 
 _base_onload = "document.getElementById('id_{}').value = {};"
 
@@ -31,12 +48,168 @@ def index(request):
 
 def about(request):
     return render(request, 'ratecalc/about.html', context={})
+
+def show_stats(request):
+    """Timing statistics of the views (see utils.timing); with ?reset=1
+    they are cleared after being returned
+    """
+    stats = get_stats()
+    if request.GET.get('reset') == '1':
+        reset_stats()
+
+    return JsonResponse(stats)
     
 def show_lightcurve(request, tm_name, n_bands=5):
+    context, data = get_lightcurve_data(request, tm_name, n_bands)
+    return render_plot(request, context, data)
+
+@csrf_exempt
+def lightcurve_json(request, tm_name, n_bands=5):
+    return render_json(request, get_lightcurve_data(request, tm_name,
+                                                    n_bands)[1])
+
+def show_expected(request, tm_name, n_bands=5):
+    context, data = get_expected_data(request, tm_name, n_bands)
+    return render_plot(request, context, data)
+
+@csrf_exempt
+def expected_json(request, tm_name, n_bands=5):
+    return render_json(request, get_expected_data(request, tm_name,
+                                                  n_bands)[1])
+
+def show_redshift(request, tm_name):
+    context, data = get_redshift_data(request, tm_name)
+    return render_plot(request, context, data)
+
+@csrf_exempt
+def redshift_json(request, tm_name):
+    return render_json(request, get_redshift_data(request, tm_name)[1])
+
+@csrf_exempt
+def lightcurve_export(request, tm_name, fmt, n_bands=5):
+    return export_data(request, get_lightcurve_data(request, tm_name,
+                                                    n_bands)[1], fmt)
+
+@csrf_exempt
+def expected_export(request, tm_name, fmt, n_bands=5):
+    return export_data(request, get_expected_data(request, tm_name,
+                                                  n_bands)[1], fmt)
+
+@csrf_exempt
+def redshift_export(request, tm_name, fmt):
+    return export_data(request, get_redshift_data(request, tm_name)[1], fmt)
+
+def render_plot(request, context, data):
+    """Render the form and the plot of data, either as SVG (default) or,
+    for ?plot=client, drawn by the browser from the embedded JSON data.
+    The SVG and the data table are added to the cached data.
+    """
+    timer = get_timer(request)
+    if 'error' in data:
+        context['plot'] = 'Error: %s'%data['error']
+        context['plot_data'] = 'None'
+        timer.start('render')
+        return render(request, 'ratecalc/form_plot.html', context)
+
+    etag = get_etag(data['key'], 'html', request.GET.get('plot'))
+    if etag_matches(request, etag):
+        return set_etag(HttpResponseNotModified(), etag, weak=True)
+
+    update = False
+    if request.GET.get('plot') == 'client':
+        context['plot_json'] = mark_safe(
+            json.dumps(get_json_data(data)).replace('</', '<\\/')
+        )
+    else:
+        if 'svg' not in data:
+            timer.start('plot')
+            data['svg'] = _plot_funcs[data['kind']](*data['plot_args'])
+            update = True
+        context['plot'] = data['svg']
+    context['export_action'] = '%s_export'%data['kind']
+
+    if 'table' not in data:
+        timer.start('format')
+        data['table'] = _format_funcs[data['kind']](*data['format_args'])
+        update = True
+    context['plot_data'] = data['table']
+
+    if update:
+        set_cached_response(data['key'], data)
+
+    timer.start('render')
+    return set_etag(render(request, 'ratecalc/form_plot.html', context), etag,
+                    weak=True)
+
+def render_json(request, data):
+    """
+    """
+    get_timer(request).start('render')
+    if 'errors' in data:
+        return JsonResponse({'errors': data['errors']}, status=400)
+    elif 'error' in data:
+        return JsonResponse({'error': data['error']}, status=400)
+
+    etag = get_etag(data['key'], 'json')
+    if etag_matches(request, etag):
+        return set_etag(HttpResponseNotModified(), etag)
+
+    return set_etag(JsonResponse(get_json_data(data)), etag)
+
+def export_data(request, data, fmt):
+    """Stream the table of data (x and one column per series) as CSV, .npy
+    or the binary format of utils/formatdata.py
+    """
+    get_timer(request).start('render')
+    if 'errors' in data:
+        return JsonResponse({'errors': data['errors']}, status=400)
+    elif 'error' in data:
+        return HttpResponseBadRequest('Error: %s'%data['error'],
+                                      content_type='text/plain')
+
+    etag = get_etag(data['key'], 'export', fmt)
+    if etag_matches(request, etag):
+        return set_etag(HttpResponseNotModified(), etag)
+
+    table = get_table(data['x']['values'], data['series'])
+    columns = [data['x']['name']] + list(data['labels'])
+    if fmt == 'csv':
+        content, content_type = iter_csv(table, columns), 'text/csv'
+    elif fmt == 'npy':
+        content, content_type = iter_npy(table), 'application/octet-stream'
+    else:
+        content = iter_binary(table, columns)
+        content_type = 'application/octet-stream'
+
+    response = StreamingHttpResponse(content, content_type=content_type)
+    response['Content-Disposition'] = ('attachment; filename="%s_%s.%s"'
+                                       %(data['model'], data['kind'], fmt))
+    return set_etag(response, etag)
+
+def get_json_data(data):
+    """Plain-data version of the result of get_*_data: axes with names,
+    labels and units and one series of values per label (NaN as null)
+    """
+    return {'model': data['model'], 'kind': data['kind'],
+            'x': dict(data['x'], values=_to_list_(data['x']['values'])),
+            'y': data['y'], 'options': data['options'],
+            'series': [{'label': l, 'values': _to_list_(v)}
+                       for l, v in zip(data['labels'], data['series'])]}
+
+def _to_list_(values):
+    values = np.asarray(values, dtype=float)
+    return [v if np.isfinite(v) else None for v in values.tolist()]
+
+def get_lightcurve_data(request, tm_name, n_bands=5):
+    """Form context and light curves of the model (see get_json_data for the
+    format of the data)
+    """
     context = get_calc(request, tm_name,
                        [], n_bands=n_bands,
                        band='bessellux', magsys='ab',
                        scale_mode='lc')
+    if 'errors' in context:
+        return context, get_error_data(context)
 
     bands = [context['calc_kw']['band']]
     magsys = [context['calc_kw']['magsys']]
@@ -50,6 +223,25 @@ def show_lightcurve(request, tm_name, n_bands=5):
     bands = [b for b in bands if b != 'None']
     labels = [_band_dict[b] for b in bands]
 
+    key = get_response_key('lightcurve', context['key_params'])
+    data = get_cached_response(key)
+    if data is None:
+        data = _get_lightcurve_data_(request, tm_name, context, bands, magsys,
+                                     labels)
+        set_cached_response(key, data)
+
+    if 'z' in data.get('derived', {}):
+        context['form'].fields['z'].initial = data['derived']['z']
+
+    data['key'] = key
+    return context, data
+
+def _get_lightcurve_data_(request, tm_name, context, bands, magsys, labels):
+    """
+    """
+    derived = {}
+    timer = get_timer(request)
+    timer.start('scale')
     transient_model = context['calc_args'][0]
     if context['scale_opt']['scale_amplitude']:
         if context['scale_opt']['scaling_mode'] == 'z':
@@ -66,7 +258,7 @@ def show_lightcurve(request, tm_name, n_bands=5):
             transient_model.set(z=z)
             transient_model = scale_model(transient_model)
             if 'cleaned_data' in context['form'].__dict__.keys():
-                context['form'].fields['z'].initial = z
+                derived['z'] = z
         elif context['scale_opt']['scaling_mode'] == 'abs_mag':
             transient_model = scale_model(
                 transient_model,
@@ -76,26 +268,35 @@ def show_lightcurve(request, tm_name, n_bands=5):
             )
 
     log_t = context['calc_kw'].pop('log_t', False)
-    n_points = context['calc_kw'].pop('n_points', 100)
+    n_points = int(context['calc_kw'].pop('n_points', 100))
     mag_cut = context['calc_kw'].pop('mag_range', 8)
     t_range = (context['calc_kw'].pop('t_min', transient_model.mintime()),
                context['calc_kw'].pop('t_max', transient_model.maxtime()))
             
     try:
+        timer.start('compute')
         phase, mags = get_lightcurves(transient_model, bands, magsys,
                                       t_range, log_t, n_points)
-        plot = plot_lightcurve(phase, mags, labels, mag_cut, log_t)
-        plot_data = format_lightcurve_data(phase, mags, labels, log_t)
     except ValueError as e:
-        plot = 'Error: %s'%e
-        plot_data = 'None'
-        
-    context['plot'] = plot
-    context['plot_data'] = plot_data
-        
-    return render(request, 'ratecalc/form_plot.html', context)
-    
-def show_expected(request, tm_name, n_bands=5):
+        timer.stop()
+        return {'error': str(e), 'derived': derived}
+
+    timer.stop()
+    return {
+        'model': tm_name, 'kind': 'lightcurve', 'derived': derived,
+        'plot_args': (phase, mags, labels, mag_cut, log_t),
+        'format_args': (phase, mags, labels, log_t),
+        'x': {'name': 'time', 'label': 't - t0', 'unit': 'days',
+              'values': phase},
+        'y': {'name': 'mag', 'label': 'Magnitude', 'unit': 'mag'},
+        'labels': labels, 'series': mags,
+        'options': {'log_x': log_t, 'reverse_y': True, 'y_range': mag_cut}
+    }
+
+def get_expected_data(request, tm_name, n_bands=5):
+    """Form context and expected numbers of transients as a function of
+    limiting magnitude
+    """
     context = get_calc(request, tm_name,
                        ['area', 'time', 'rate',
                         'mag_start', 'mag_lim', 't_before',
@@ -103,71 +304,119 @@ def show_expected(request, tm_name, n_bands=5):
                        hide_param=['z'], band='bessellux', magsys='ab',
                        mag_start=19., mag_lim=24., t_before=0., n_bands=n_bands,
                        scale_mode='rate')
+    if 'errors' in context:
+        return context, get_error_data(context)
 
     add_bands = [context['calc_kw'].pop('band%i'%k, 'None')
                  for k in range(1, n_bands)]
     add_magsys = [context['calc_kw'].pop('magsys%i'%k, 'ab')
                   for k in range(1, n_bands)]
     
-    calc = RateCalculator(*context['calc_args'], **context['calc_kw'])
+    bands = [context['calc_kw'].pop('band')]
+    magsys = [context['calc_kw'].pop('magsys')]
+    for b, ms in zip(add_bands, add_magsys):
+        if b != 'None':
+            bands.append(b)
+            magsys.append(ms)
+
+    key = get_response_key('expected', context['key_params'])
+    data = get_cached_response(key)
+    if data is None:
+        data = _get_expected_data_(request, tm_name, context, bands, magsys)
+        set_cached_response(key, data)
+
+    data['key'] = key
+    return context, data
+
+def _get_expected_data_(request, tm_name, context, bands, magsys):
+    """
+    """
+    timer = get_timer(request)
+    timer.start('calc')
+    calc = MultiBandRateCalculator(*context['calc_args'], bands=bands,
+                                   magsys=magsys, cache=get_table_cache(),
+                                   **context['calc_kw'])
     
-    mag_lim = calc.mag_lim
-    if calc.mag_disp is not None:
-        mag_lim -= calc.sigma_cut * calc.mag_disp
+    mag_lim = calc.calcs[0].mag_lim
+    if calc.calcs[0].mag_disp is not None:
+        mag_lim -= calc.calcs[0].sigma_cut * calc.calcs[0].mag_disp
         
+    timer.start('compute')
     mag = np.linspace(context['mag_start'], mag_lim, 41)
-    n = [[calc.get_n_expected(m) for m in mag]]
-    labels = [_band_dict[calc.band]]
+    n = calc.get_n_expected(mag)
+    labels = [_band_dict[b] for b in bands]
+    timer.stop()
 
-    for b, ms in zip(add_bands, add_magsys):
-        if b != 'None':
-            context['calc_kw']['band'] = b
-            context['calc_kw']['magsys'] = ms
-            calc = RateCalculator(*context['calc_args'], **context['calc_kw'])
-            
-            n.append([calc.get_n_expected(m) for m in mag])
-            labels.append(_band_dict[calc.band])
-    
-    plot = plot_expected(mag, n, labels)
-    plot_data = format_expected_data(mag, n, labels)
-    
-    context['plot'] = plot
-    context['plot_data'] = plot_data
-    
-    return render(request, 'ratecalc/form_plot.html', context)
+    return {
+        'model': tm_name, 'kind': 'expected',
+        'plot_args': (mag, n, labels), 'format_args': (mag, n, labels),
+        'x': {'name': 'mag_lim', 'label': 'Limiting magnitude',
+              'unit': 'mag', 'values': mag},
+        'y': {'name': 'n', 'label': '# expected transients', 'unit': ''},
+        'labels': labels, 'series': n,
+        'options': {'log_y': True}
+    }
 
-def show_redshift(request, tm_name):
+def get_redshift_data(request, tm_name):
+    """Form context and redshift distribution of the expected transients
+    """
     context = get_calc(request, tm_name,
                        ['area', 'time', 'rate',
                         'mag_lim', 't_before',
                         'mag_disp'],
                        hide_param=['z'], band='bessellux', magsys='ab',
                        mag_lim=24., t_before=0., scale_mode='rate')
+    if 'errors' in context:
+        return context, get_error_data(context)
 
-    calc = RateCalculator(*context['calc_args'], **context['calc_kw'])
+    key = get_response_key('redshift', context['key_params'])
+    data = get_cached_response(key)
+    if data is None:
+        data = _get_redshift_data_(request, tm_name, context)
+        set_cached_response(key, data)
+
+    data['key'] = key
+    return context, data
+
+def _get_redshift_data_(request, tm_name, context):
+    """
+    """
+    timer = get_timer(request)
+    timer.start('calc')
+    calc = RateCalculator(*context['calc_args'], cache=get_table_cache(),
+                          **context['calc_kw'])
     
+    timer.start('compute')
     z, n = calc.get_z_dist(context['calc_kw']['mag_lim'])
-    plot = plot_redshift(z, n)
-    plot_data = format_redshift_data(z, n)
-    
-    context['plot'] = plot
-    context['plot_data'] = plot_data
-        
-    return render(request, 'ratecalc/form_plot.html', context)
-    
+    timer.stop()
+
+    return {
+        'model': tm_name, 'kind': 'redshift',
+        'plot_args': (z, n), 'format_args': (z, n),
+        'x': {'name': 'z', 'label': 'Redshift (bin center)', 'unit': '',
+              'values': z},
+        'y': {'name': 'n', 'label': '# expected transients', 'unit': ''},
+        'labels': [_band_dict[calc.band]], 'series': [n],
+        'options': {'bar': True}
+    }
+
+_plot_funcs = {'lightcurve': plot_lightcurve, 'expected': plot_expected,
+               'redshift': plot_redshift}
+_format_funcs = {'lightcurve': format_lightcurve_data,
+                 'expected': format_expected_data,
+                 'redshift': format_redshift_data}
     
 def get_calc(request, tm_name, include_fields, mag_start=None, hide_param=None,
              n_bands=1, scale_mode='lc', **kw):
     if hide_param is None:
         hide_param = []
         
+    timer = get_timer(request)
+    timer.start('db')
     tm = TransientModel.objects.get(name=tm_name)
 
-    transient_model = get_transient_model(model_type=tm.category.model_type,
-                                          sncosmo_name=tm.sncosmo_name,
-                                          amplitude=tm.default_amplitude,
-                                          model_file=tm.model_file,
-                                          host_extinction=tm.host_extinction)
+    timer.start('model')
+    transient_model = get_cached_transient_model(**get_transient_model_kw(tm))
     
     calc_kw = {'mag_max': tm.transient_type.m_B_max,
                'mag_disp': tm.transient_type.sig_m_B_max,
@@ -176,6 +425,7 @@ def get_calc(request, tm_name, include_fields, mag_start=None, hide_param=None,
     scale_opt = {'scale_amplitude': False,
                  'scaling_mode': 'z'}
     
+    timer.start('form')
     form = TransientForm(transient_model=transient_model, hide_param=hide_param,
                          n_bands=n_bands, include_fields=include_fields,
                          scale_mode=scale_mode, **calc_kw)
@@ -187,8 +437,11 @@ def get_calc(request, tm_name, include_fields, mag_start=None, hide_param=None,
                              **calc_kw)
 
         if not form.is_valid():
-            print(form.errors)
- 
+            timer.stop()
+            return {'tm': tm, 'form': form, 'mag_start': mag_start,
+                    'action': resolve(request.path_info).url_name,
+                    'errors': get_form_errors(form)}
+
         transient_model.set(**{k: v for k, v in form.cleaned_data.items()
                                if k in transient_model.param_names})
 
@@ -210,20 +463,118 @@ def get_calc(request, tm_name, include_fields, mag_start=None, hide_param=None,
             if k not in transient_model.param_names:
                 calc_kw[k] = v
     else:
+        # The initial values of the form (as a browser would submit them),
+        # so that a GET has the same inputs and response key as the
+        # equivalent POST
+        for k, v in get_initial_data(form).items():
+            if (k not in transient_model.param_names and k not in scale_opt
+                and k not in ['mag_start', 'mag_max', 'band_max',
+                              'magsys_max']):
+                calc_kw[k] = v
         for k, v in kw.items():
             calc_kw[k] = v
             
-    rate = calc_kw.pop('rate')
-    calc_kw['ratefunc'] = lambda z: rate
+    rate_kw = get_rate_kw(tm.transient_type, calc_kw.pop('rate'))
+    calc_kw['ratefunc'] = get_rate_model(**rate_kw)
 
     if not scale_opt['scale_amplitude']:
         calc_kw['mag_max'] = None
 
+    # All inputs of the calculation (for the response cache) incl. the
+    # versions of the model file (as repr, floats in key_params are
+    # rounded) and of the bandpass data
+    model_kw = get_transient_model_kw(tm)
+    key_params = {'tm': tm.name, 'model_kw': model_kw,
+                  'model_stamp': repr(get_model_file_stamp(**model_kw)),
+                  'bandpasses': get_bandpass_ids(calc_kw),
+                  'rate_kw': rate_kw, 'mag_start': mag_start,
+                  'n_bands': n_bands, 'scale_opt': scale_opt,
+                  'params': dict(zip(transient_model.param_names,
+                                     transient_model.parameters)),
+                  'calc_kw': {k: v for k, v in calc_kw.items()
+                              if k != 'ratefunc'}}
+    timer.stop()
+
     context = {'tm': tm, 'form': form, 'mag_start': mag_start,
                'action': resolve(request.path_info).url_name,
                'calc_kw': calc_kw, 'calc_args': (transient_model, ),
-               'scale_opt': scale_opt}
+               'scale_opt': scale_opt, 'key_params': key_params}
     
     return context
 
-        
\ No newline at end of file
+        
+
+def get_initial_data(form):
+    """Initial values of the fields of an unbound form (the first choice
+    for choice fields without one)
+    """
+    data = {}
+    for f in form:
+        value = f.value()
+        if value is None and hasattr(f.field, 'choices'):
+            value = f.field.choices[0][0]
+        data[f.name] = value
+
+    return data
+
+def get_form_errors(form):
+    """Error messages of an invalid form by field
+    """
+    return {k: [e['message'] for e in v.get_json_data()]
+            for k, v in form.errors.items()}
+
+def get_error_data(context):
+    """Data (see get_json_data) of a request with invalid inputs
+    """
+    return {'error': 'Invalid input (%s)'%'; '.join(
+                '%s: %s'%(k, ' '.join(v))
+                for k, v in sorted(context['errors'].items())),
+            'errors': context['errors']}
+
+def get_bandpass_ids(calc_kw):
+    """Identities (see get_bandpass_id) of the bands in calc_kw: band and
+    magsys, band<k> and magsys<k> and the band of mag_max
+    """
+    pairs = [(calc_kw[k], calc_kw.get(k.replace('band', 'magsys'), 'ab'))
+             for k in sorted(calc_kw.keys()) if k.startswith('band')]
+    if calc_kw.get('mag_max') is not None and not np.isscalar(
+            calc_kw['mag_max']):
+        pairs.append(tuple(calc_kw['mag_max'][1:]))
+
+    return [get_bandpass_id(b, ms) for b, ms in pairs if b != 'None']
+
+def get_rate_kw(transient_type, rate):
+    """Keyword arguments of get_rate_model for a TransientType with rate at
+    z = 0
+    """
+    rate_kw = {'rate_model': transient_type.rate_model, 'r0': rate}
+    if transient_type.rate_params:
+        rate_kw.update(json.loads(transient_type.rate_params))
+    if transient_type.rate_model == 'tabulated':
+        rate_kw['rate_file'] = transient_type.rate_file
+
+    return rate_kw
+
+def get_transient_model_kw(tm):
+    """Keyword arguments of get_transient_model for a TransientModel
+    """
+    return {'model_type': tm.category.model_type,
+            'sncosmo_name': tm.sncosmo_name,
+            'amplitude': tm.default_amplitude,
+            'model_file': tm.model_file,
+            'host_extinction': tm.host_extinction}
+
+def warm_model_registry():
+    """Build the models of all TransientModels (see
+    get_cached_transient_model)
+    """
+    try:
+        tms = list(TransientModel.objects.all())
+    except DatabaseError:
+        return
+
+    for tm in tms:
+        try:
+            get_cached_transient_model(**get_transient_model_kw(tm))
+        except Exception as e:
+            logger.warning('Could not load model %s: %s', tm.name, e)
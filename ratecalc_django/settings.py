@@ -16,6 +16,27 @@ import os
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 TEMPLATE_DIR = os.path.join(BASE_DIR, 'templates')
 STATIC_DIR = os.path.join(BASE_DIR, 'static')
+CACHE_DIR = os.path.join(BASE_DIR, 'cache')
+
+# Maximum size of the on-disk cache of magnitude-redshift tables in bytes
+TABLE_CACHE_MAX_SIZE = 200 * 1024**2
+
+# Number of sncosmo models kept in memory by get_cached_transient_model and
+# whether to build them for all transient models at startup
+MODEL_REGISTRY_SIZE = 64
+WARM_MODEL_REGISTRY = False
+
+# Number of rendered SVG plots kept in memory and optional directory (shared
+# by all processes) and maximum size in bytes of the on-disk plot cache
+PLOT_CACHE_SIZE = 128
+PLOT_CACHE_DIR = None
+PLOT_CACHE_MAX_SIZE = 50 * 1024**2
+
+# Cache of the results of the calculator views (see utils/responsecache.py):
+# name of the cache in CACHES and number of significant digits to which
+# floats are rounded in the cache keys
+RESPONSE_CACHE_ALIAS = 'responses'
+RESPONSE_CACHE_DIGITS = 8
 
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/1.10/howto/deployment/checklist/
@@ -38,7 +59,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
-    'ratecalc',
+    'ratecalc.apps.RatecalcConfig',
 ]
 
 MIDDLEWARE = [
@@ -49,6 +70,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'ratecalc.middleware.TimingMiddleware',
 ]
 
 ROOT_URLCONF = 'ratecalc_django.urls'
@@ -83,6 +105,25 @@ DATABASES = {
 }
 
 
+# Caches
+# https://docs.djangoproject.com/en/1.10/topics/cache/
+# The responses cache may also use the file-based backend
+# ('django.core.cache.backends.filebased.FileBasedCache' with a directory
+# as LOCATION) to share the results between processes.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'responses': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'ratecalc-responses',
+        'TIMEOUT': 24 * 3600,
+        'OPTIONS': {'MAX_ENTRIES': 256},
+    },
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/1.10/ref/settings/#auth-password-validators
 
@@ -120,4 +161,29 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/1.10/howto/static-files/
 
 STATIC_URL = '/static/'
-STATICFILES_DIRS = [STATIC_DIR, ]
\ No newline at end of file
+STATICFILES_DIRS = [STATIC_DIR, ]
+
+# Logging
+# Warnings of the ratecalc app and per-request stage timings of its views
+# (see ratecalc/middleware.py)
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'ratecalc': {
+            'handlers': ['console'],
+            'level': 'WARNING',
+        },
+        'ratecalc.timing': {
+            'handlers': ['console'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+    },
+}
@@ -0,0 +1,174 @@
+// Draw the JSON data of the ratecalc views (see get_json_data in
+// ratecalc/views.py) as an SVG line or bar plot in the browser.
+
+var ratecalcColors = ['#1f77b4', '#ff7f0e', '#2ca02c', '#d62728', '#9467bd'];
+
+function ratecalcPlot(container, data, width, height) {
+    width = width || 640;
+    height = height || 480;
+    var margin = {left: 70, right: 20, top: 40, bottom: 50};
+    var opt = data.options || {};
+    var ns = 'http://www.w3.org/2000/svg';
+
+    function el(name, attrs, text) {
+        var e = document.createElementNS(ns, name);
+        for (var k in attrs) {
+            e.setAttribute(k, attrs[k]);
+        }
+        if (text !== undefined) {
+            e.textContent = text;
+        }
+        return e;
+    }
+
+    function finite(values, log) {
+        return values.filter(function (v) {
+            return v !== null && (!log || v > 0);
+        });
+    }
+
+    function makeScale(lo, hi, a, b, log) {
+        var f = log ? Math.log : function (v) { return v; };
+        var l0 = f(lo), l1 = f(hi);
+        if (l1 === l0) {
+            l1 = l0 + 1;
+        }
+        var s = function (v) { return a + (f(v) - l0) / (l1 - l0) * (b - a); };
+        s.ticks = function () {
+            var ticks = [];
+            if (log) {
+                for (var e = Math.floor(l0 / Math.LN10);
+                     e <= Math.ceil(l1 / Math.LN10); e++) {
+                    var t = Math.pow(10, e);
+                    if (t >= Math.min(lo, hi) && t <= Math.max(lo, hi)) {
+                        ticks.push(t);
+                    }
+                }
+                return ticks;
+            }
+            var lo_ = Math.min(lo, hi), hi_ = Math.max(lo, hi);
+            var step = Math.pow(10, Math.floor(Math.log(hi_ - lo_) / Math.LN10));
+            if ((hi_ - lo_) / step < 4) {
+                step /= 2;
+            }
+            for (var t = Math.ceil(lo_ / step) * step; t <= hi_; t += step) {
+                ticks.push(Math.round(t / step) * step);
+            }
+            return ticks;
+        };
+        return s;
+    }
+
+    var x = data.x.values;
+    var xFinite = finite(x, opt.log_x);
+    var yFinite = [];
+    data.series.forEach(function (s) {
+        yFinite = yFinite.concat(finite(s.values, opt.log_y));
+    });
+
+    var xMin = Math.min.apply(null, xFinite);
+    var xMax = Math.max.apply(null, xFinite);
+    var yMin = Math.min.apply(null, yFinite);
+    var yMax = Math.max.apply(null, yFinite);
+    var barWidth = 0;
+    if (opt.bar) {
+        barWidth = x[1] - x[0];
+        xMin -= barWidth / 2;
+        xMax += barWidth / 2;
+        yMin = 0;
+    }
+    if (opt.reverse_y) {
+        // Light curves: magnitudes from one above the peak to at most
+        // y_range below it
+        yMin -= 1;
+        if (opt.y_range && yMax - yMin > opt.y_range) {
+            yMax = yMin + opt.y_range;
+        }
+    }
+
+    var sx = makeScale(xMin, xMax, margin.left, width - margin.right,
+                       opt.log_x);
+    var sy = opt.reverse_y
+        ? makeScale(yMin, yMax, margin.top, height - margin.bottom, false)
+        : makeScale(yMin, yMax, height - margin.bottom, margin.top,
+                    opt.log_y);
+
+    var svg = el('svg', {width: width, height: height,
+                         'font-family': 'sans-serif', 'font-size': 12});
+    var clip = el('clipPath', {id: 'ratecalc-clip'});
+    clip.appendChild(el('rect', {x: margin.left, y: margin.top,
+                                 width: width - margin.left - margin.right,
+                                 height: height - margin.top - margin.bottom}));
+    svg.appendChild(clip);
+
+    sx.ticks().forEach(function (t) {
+        svg.appendChild(el('line', {x1: sx(t), x2: sx(t), y1: margin.top,
+                                    y2: height - margin.bottom,
+                                    stroke: '#ddd'}));
+        svg.appendChild(el('text', {x: sx(t), y: height - margin.bottom + 16,
+                                    'text-anchor': 'middle'},
+                           opt.log_x ? t.toExponential(0) : +t.toFixed(6)));
+    });
+    sy.ticks().forEach(function (t) {
+        svg.appendChild(el('line', {x1: margin.left, x2: width - margin.right,
+                                    y1: sy(t), y2: sy(t), stroke: '#ddd'}));
+        svg.appendChild(el('text', {x: margin.left - 6, y: sy(t) + 4,
+                                    'text-anchor': 'end'},
+                           opt.log_y ? t.toExponential(0) : +t.toFixed(6)));
+    });
+    svg.appendChild(el('rect', {x: margin.left, y: margin.top,
+                                width: width - margin.left - margin.right,
+                                height: height - margin.top - margin.bottom,
+                                fill: 'none', stroke: 'black'}));
+
+    data.series.forEach(function (s, k) {
+        var color = ratecalcColors[k % ratecalcColors.length];
+        var g = el('g', {'clip-path': 'url(#ratecalc-clip)'});
+        if (opt.bar) {
+            s.values.forEach(function (v, i) {
+                if (v === null) {
+                    return;
+                }
+                var x0 = sx(x[i] - barWidth / 2), x1 = sx(x[i] + barWidth / 2);
+                g.appendChild(el('rect', {x: x0, y: sy(v), width: x1 - x0,
+                                          height: sy(yMin) - sy(v),
+                                          fill: color}));
+            });
+        } else {
+            var d = '';
+            s.values.forEach(function (v, i) {
+                if (v === null || (opt.log_y && v <= 0)
+                    || (opt.log_x && x[i] <= 0)) {
+                    d += ' ';
+                    return;
+                }
+                d += (d === '' || d.slice(-1) === ' ' ? 'M' : 'L')
+                    + sx(x[i]).toFixed(2) + ',' + sy(v).toFixed(2);
+            });
+            g.appendChild(el('path', {d: d, fill: 'none', stroke: color,
+                                      'stroke-width': 1.5}));
+        }
+        svg.appendChild(g);
+
+        if (data.series.length > 1 || !opt.bar) {
+            var lx = margin.left + k * 100;
+            svg.appendChild(el('line', {x1: lx, x2: lx + 20, y1: 20, y2: 20,
+                                        stroke: color, 'stroke-width': 2}));
+            svg.appendChild(el('text', {x: lx + 25, y: 24}, s.label));
+        }
+    });
+
+    function axisLabel(axis) {
+        return axis.label + (axis.unit ? ' [' + axis.unit + ']' : '');
+    }
+    svg.appendChild(el('text', {x: (width + margin.left - margin.right) / 2,
+                                y: height - 10, 'text-anchor': 'middle',
+                                'font-size': 14}, axisLabel(data.x)));
+    var yc = (height + margin.top - margin.bottom) / 2;
+    svg.appendChild(el('text', {x: 16, y: yc, 'text-anchor': 'middle',
+                                'font-size': 14,
+                                transform: 'rotate(-90 16 ' + yc + ')'},
+                       axisLabel(data.y)));
+
+    container.appendChild(svg);
+}